@@ -0,0 +1,135 @@
+import os
+import pandas as pd
+import pyarrow.dataset as ds
+
+import store
+
+CUBE_FILE = "climate-data-ncbn-{}.parquet"
+# group keys of the aggregate cube for each time aggregation
+CUBE_KEYS = {
+    "week": ["station", "year", "week"],
+    "month": ["station", "year", "month"],
+    "year": ["station", "year"],
+    "decade": ["station", "decade"],
+}
+
+
+def get_cube_file(time_aggregation: str, folder: str = None):
+    """Returns the cube file in dataset directory folder, the current if None."""
+    return store.get_derived_file(CUBE_FILE.format(time_aggregation), folder)
+
+
+def cubes_exist():
+    return all(os.path.exists(get_cube_file(x)) for x in CUBE_KEYS)
+
+
+def aggregate(df: pd.DataFrame, keys: list, agg_dict: dict):
+    """
+    Aggregates the daily data by keys, each parameter with its aggregation
+    function. Groups without any value are set to NaN, so a sum over missing
+    values does not show up as 0.
+
+    :param df: daily data
+    :param keys: group keys
+    :param agg_dict: aggregation function for each parameter
+    :return: DataFrame with the keys and the aggregated parameters
+    """
+    parameters = list(agg_dict.keys())
+    grouped = df.groupby(keys, observed=True)
+    result = grouped[parameters].agg(agg_dict)
+    return result.where(grouped[parameters].count() > 0).reset_index()
+
+
+def build_cube(df: pd.DataFrame, time_aggregation: str, agg_dict: dict):
+    """
+    Aggregates the daily data by station and time_aggregation, see aggregate.
+
+    :param df: daily data
+    :param time_aggregation: week, month, year or decade
+    :param agg_dict: aggregation function for each parameter
+    :return: DataFrame with the cube keys, decade and the aggregated parameters
+    """
+    cube = aggregate(df, CUBE_KEYS[time_aggregation], agg_dict)
+    if time_aggregation != "decade":
+        cube["decade"] = (cube["year"] // 10) * 10
+    return cube
+
+
+def write_cubes(df: pd.DataFrame, agg_dict: dict, folder: str, decades: list = None):
+    """
+    Writes the aggregate cubes of all time aggregations.
+
+    :param df: daily data
+    :param agg_dict: aggregation function for each parameter
+    :param folder: dataset directory, see store.create_staging_dir
+    :param decades: if given, df holds the data of these decades only and only
+                    the cube rows of these decades are replaced
+    """
+    for time_aggregation, keys in CUBE_KEYS.items():
+        cube = build_cube(df, time_aggregation, agg_dict)
+        cube_file = get_cube_file(time_aggregation, folder)
+        if decades is not None and os.path.exists(cube_file):
+            existing_df = pd.read_parquet(cube_file)
+            existing_df = existing_df[~existing_df["decade"].isin(decades)]
+            cube = pd.concat([existing_df, cube], ignore_index=True)
+            cube = cube.sort_values(by=keys, ignore_index=True)
+        store.write_parquet(cube, cube_file)
+
+
+def cube_supports(time_aggregation: str, filters: dict, min_year: int, max_year: int):
+    """
+    Returns True if the aggregated values for filters can be read from the cube
+    of time_aggregation. This is not the case for daily values, for month
+    filters on other than monthly values and for year filters cutting a decade
+    for decadal values, since they select days within an aggregation period.
+
+    :param time_aggregation: day, week, month, year or decade
+    :param filters: filter dict as returned by show_filter
+    :param min_year: first year of the data
+    :param max_year: last year of the data
+    """
+    if time_aggregation not in CUBE_KEYS:
+        return False
+    if "region" in filters and filters["region"] != []:
+        return False
+    has_month_filter = "month" in filters or filters.get("months") not in (None, [])
+    if has_month_filter and time_aggregation != "month":
+        return False
+    if time_aggregation == "decade":
+        if "year" in filters:
+            return False
+        if "years" in filters and filters["years"] != []:
+            first_year, last_year = filters["years"]
+            if first_year > min_year and first_year % 10 != 0:
+                return False
+            if last_year < max_year and last_year % 10 != 9:
+                return False
+    return True
+
+
+def read_cube(
+    time_aggregation: str, filters: dict, parameters: list, version: str = None
+):
+    """
+    Reads the aggregated values matching filters from the cube of
+    time_aggregation, check cube_supports first.
+
+    :param time_aggregation: week, month, year or decade
+    :param filters: filter dict as returned by show_filter
+    :param parameters: parameters to be read
+    :param version: data version, see store.get_data_version, current if None
+    :return: DataFrame with the cube keys and the parameters
+    """
+    if time_aggregation == "decade" and filters.get("years", []) != []:
+        # the years are decade aligned, see cube_supports
+        first_year, last_year = filters["years"]
+        filters = {key: value for key, value in filters.items() if key != "years"}
+        filters["decades"] = [(first_year // 10) * 10, (last_year // 10) * 10]
+    expression = store.get_filter_expression(filters)
+    cube_file = get_cube_file(time_aggregation, store.get_version_dir(version))
+    dataset = ds.dataset(cube_file, format="parquet")
+    columns = CUBE_KEYS[time_aggregation] + parameters
+    df = dataset.to_table(columns=columns, filter=expression).to_pandas()
+    if len(parameters) == 1:
+        df = df.dropna(subset=parameters)
+    return df
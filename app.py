@@ -1,3 +1,10 @@
+import time
+
+# start of the script run, the imports below are the first startup stage
+START_TIME = time.perf_counter()
+
+import os
+import json
 import streamlit as st
 import pandas as pd
 from streamlit_lottie import st_lottie
@@ -8,6 +15,11 @@ from enum import Enum
 import datetime
 
 import nbcn
+import cache
+import timing
+import refresh
+
+IMPORT_SECONDS = time.perf_counter() - START_TIME
 
 __version__ = "0.0.12"
 __author__ = "Lukas Calmbach"
@@ -20,6 +32,10 @@ PAGE = "app"
 lang = {}
 LOTTIE_URL = "https://assets9.lottiefiles.com/temp/lf20_rpC1Rd.json"
 LOTTIE_URL = "https://lottie.host/016f9a14-ca58-4ade-85fa-ccce6bbc9318/ApQE6zjqWN.json"
+LOTTIE_FILE = "./data/lottie.json"
+REQUEST_TIMEOUT = 10
+# seconds used by each startup stage of the current script run
+stages = {}
 
 
 class Menu(Enum):
@@ -48,7 +64,6 @@ def init():
         st.session_state["lang"] = next(
             iter(st.session_state["used_languages_dict"].items())
         )[0]
-        st.session_state["last_data_refresh"] = datetime.datetime.now().strftime("%x")
 
 
 def get_menu_selection(menu_options):
@@ -64,6 +79,22 @@ def get_menu_selection(menu_options):
         )
 
 
+def get_refresh_info():
+    """Returns the time of the last data refresh and whether a refresh is
+    running or the last one failed, see refresh.read_status."""
+    status = refresh.read_status()
+    if not status.get("last_refresh"):
+        info = "-"
+    else:
+        last_refresh = datetime.datetime.fromisoformat(status["last_refresh"])
+        info = last_refresh.strftime("%x %H:%M")
+    if status.get("state") == "running":
+        info += f" ({lang['data-refresh-running']})"
+    elif status.get("state") == "failed":
+        info += f" ({lang['data-refresh-failed']})"
+    return info
+
+
 def get_app_info():
     """
     Returns a string containing information about the application.
@@ -75,12 +106,14 @@ def get_app_info():
     version = lang["version"]
     translation = lang["translation"]
     data_source = lang["data-source"]
+    data_refresh = lang["data-refresh"]
 
     info = f"""<div style="background-color:powderblue; padding: 10px;border-radius: 15px;">
     <small>{created_by} <a href="mailto:{__author_email__}">{__author__}</a><br>
     {version}: {__version__} ({VERSION_DATE})<br>
     {data_source}: <a href="https://opendata.swiss/de/dataset/klimamessnetz-tageswerte">MeteoSwiss</a><br>
-    {powered_by} <a href="https://streamlit.io/">Streamlit</a>, <a href="https://github.com/mmhs013/pymannkendall">pymannkendall</a><br>
+    {data_refresh}: {get_refresh_info()}<br>
+    {powered_by} <a href="https://streamlit.io/">Streamlit</a><br>
     {translation} <a href="https://lcalmbach-gpt-translate-app-i49g8c.streamlit.app/">PolyglotGPT</a><br>
     <a href="{GIT_REPO}">git-repo</a><br>
     """
@@ -109,24 +142,27 @@ def display_language_selection():
 
 @st.cache_data(show_spinner=False)
 def get_lottie():
-    """Performs a GET request to fetch JSON data from a specified URL.
+    """Returns the JSON data of the lottie animation. The animation is read
+    from LOTTIE_FILE, it is only downloaded from LOTTIE_URL if the file does
+    not exist yet.
 
     Returns:
         tuple: A tuple containing the JSON response and a flag indicating the
         success of the request.
-
-    Raises:
-        requests.exceptions.RequestException: If an error occurs during the
-        GET request. ValueError: If an error occurs while parsing the JSON
-        response.
     """
     ok = True
     r = None
+    if os.path.exists(LOTTIE_FILE):
+        with open(LOTTIE_FILE, "r", encoding="utf-8") as file:
+            return json.load(file), ok
     try:
-        response = requests.get(LOTTIE_URL)
+        response = requests.get(LOTTIE_URL, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
         r = response.json()
+        with open(LOTTIE_FILE, "w", encoding="utf-8") as file:
+            json.dump(r, file)
     except requests.exceptions.RequestException as e:
-        print(lang["get-request-error"]).format(e)
+        print(lang["get-request-error"].format(e))
         ok = False
     except ValueError as e:
         print(lang["json-parsing-error"].format(e))
@@ -146,6 +182,33 @@ def show_lottie():
         pass
 
 
+def end_stage(name: str):
+    """Records the seconds since the end of the previous startup stage."""
+    now = time.perf_counter()
+    stages[name] = now - stages.get("_end", START_TIME + IMPORT_SECONDS)
+    stages["_end"] = now
+
+
+def report_startup():
+    """
+    Prints the seconds used by the startup stages of the first script run of
+    a session, i.e. the time to the first complete page. Later runs of the
+    session reuse the imported modules and are not reported.
+    """
+    if "startup_seconds" in st.session_state:
+        return
+    stages["first paint"] = time.perf_counter() - START_TIME
+    st.session_state["startup_seconds"] = {
+        "imports": IMPORT_SECONDS,
+        **{key: value for key, value in stages.items() if key != "_end"},
+    }
+    text = ", ".join(
+        f"{key} {value:.2f}s"
+        for key, value in st.session_state["startup_seconds"].items()
+    )
+    print(f"startup: {text}")
+
+
 def main() -> None:
     """
     This function runs an app that classifies text data. Depending on the user's
@@ -158,17 +221,29 @@ def main() -> None:
     """
     global lang
 
+    if timing.ENABLED:
+        timing.start_run()
     init()
+    if refresh.SCHEDULER_ENABLED:
+        refresh.start_scheduler()
 
     lang = get_lang(PAGE)
-    with st.spinner(lang["loading-data"]):
-        # if not ("ncbn" in st.session_state):
-        st.session_state.ncbn = nbcn.NCBN(APP_NAME)
+    # if not ("ncbn" in st.session_state):
+    st.session_state.ncbn = nbcn.NCBN(APP_NAME)
+    end_stage("init")
     show_lottie()
+    end_stage("lottie")
     ncbn = st.session_state.ncbn
-    ncbn.menu_selection = get_menu_selection(ncbn.menu_options)
+    menu_selection = get_menu_selection(ncbn.menu_options)
+    # the data is loaded by the first page using it
+    with st.spinner(lang["loading-data"]):
+        ncbn.menu_selection = menu_selection
+    end_stage("page")
     display_language_selection()
     st.sidebar.markdown(get_app_info(), unsafe_allow_html=True)
+    report_startup()
+    if timing.ENABLED:
+        timing.show_panel(*timing.end_run(cache.get_query_stats()))
 
 
 if __name__ == "__main__":
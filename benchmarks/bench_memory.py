@@ -0,0 +1,165 @@
+"""
+Compares time and peak memory of filtered reads of the daily data for the
+store modes (store.STORE_MODE) on synthetic data at the scale of the full
+network, 29 stations x 160 years by default:
+
+    dataset     every read scans the partitioned parquet dataset
+    memory      the dataset is held as an Arrow table, reads filter and
+                project it in one pass
+    mmap        same, the table is memory-mapped from an Arrow IPC file
+    dataframe   reference: the decoded DataFrame of all daily data is held in
+                memory and the filters are applied as chained boolean masks
+
+Each mode runs in a fresh python process, so the peak resident memory
+(VmHWM, linux only) is its own, the resident memory after the imports is
+shown for reference. Private memory (RssAnon) is what each worker process
+adds, the mapped file is counted as shared file pages. The arrow rows show
+the memory allocated by pyarrow: held at the end of the run and at its peak.
+The data folder is built in a temporary directory.
+
+Run from the repository root: python -m benchmarks.bench_memory
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+
+MODES = ["dataset", "memory", "mmap", "dataframe"]
+REPEAT = 3
+
+
+def get_cases(stations: list, max_year: int):
+    """Returns (name, filters, columns, not_null) of the benchmarked reads."""
+    par = "tre200d0"
+    return [
+        (
+            "3 stations, 30 years",
+            {"stations": stations[:3], "years": [max_year - 29, max_year]},
+            ["station", "date", par],
+            [par],
+        ),
+        ("all stations, 1 month", {"month": 7}, ["station", "year", par], [par]),
+        ("all stations, 1 year", {"year": max_year}, ["station", "date", par], [par]),
+        ("all days, 1 parameter", {}, ["station", "year", "month", par], [par]),
+    ]
+
+
+def filter_frame(df, filters: dict, columns: list, not_null: list):
+    """Filters the decoded daily data with one boolean mask per filter, the way
+    the views filtered the full DataFrame before the store."""
+    if "stations" in filters:
+        df = df[df["station"].isin(filters["stations"])]
+    if "years" in filters:
+        df = df[df["year"] >= filters["years"][0]]
+        df = df[df["year"] <= filters["years"][1]]
+    if "year" in filters:
+        df = df[df["year"] == filters["year"]]
+    if "month" in filters:
+        df = df[df["month"] == filters["month"]]
+    df = df[columns]
+    return df.dropna(subset=not_null)
+
+
+def get_memory_mb(field: str):
+    """Returns a memory field of /proc/self/status, e.g. VmRSS, in MB."""
+    with open("/proc/self/status", "r", encoding="utf-8") as file:
+        for line in file:
+            if line.startswith(f"{field}:"):
+                return int(line.split()[1]) / 1024
+
+
+def probe(mode: str):
+    """Runs the cases in the current process and prints the results as json."""
+    # the dataframe reference reads the data once from the dataset
+    os.environ["NBCN_STORE"] = "dataset" if mode == "dataframe" else mode
+    import pyarrow as pa
+    import store
+    import nbcn_data
+
+    import_rss = get_memory_mb("VmRSS")
+    start_time = time.perf_counter()
+    stations = sorted(
+        store.get_dataset()
+        .to_table(columns=["station"])["station"]
+        .unique()
+        .to_pylist()
+    )
+    _, max_year = store.get_year_range()
+    if mode == "dataframe":
+        df = nbcn_data.read_filtered_data({})
+    elif mode in ("memory", "mmap"):
+        store.get_table()
+    result = {"load": time.perf_counter() - start_time}
+    for name, filters, columns, not_null in get_cases(stations, max_year):
+        seconds = []
+        for _ in range(REPEAT):
+            start_time = time.perf_counter()
+            if mode == "dataframe":
+                filter_frame(df, filters, columns, not_null)
+            else:
+                nbcn_data.read_filtered_data(filters, columns, not_null)
+            seconds.append(time.perf_counter() - start_time)
+        result[name] = min(seconds)
+    result["import rss MB"] = import_rss
+    result["peak rss MB"] = get_memory_mb("VmHWM")
+    result["private rss MB"] = get_memory_mb("RssAnon")
+    result["held arrow MB"] = pa.total_allocated_bytes() / 1024**2
+    result["peak arrow MB"] = pa.default_memory_pool().max_memory() / 1024**2
+    print(json.dumps(result))
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Benchmarks the store modes.")
+    parser.add_argument("--stations", type=int, default=29)
+    parser.add_argument("--years", type=int, default=160)
+    parser.add_argument("--probe", choices=MODES, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    if args.probe:
+        probe(args.probe)
+        return
+
+    import store
+    import nbcn_data
+    from benchmarks.synthetic import make_daily_data, write_data_files
+
+    root = os.getcwd()
+    df = make_daily_data(args.stations, args.years)
+    print(f"{args.stations} stations x {args.years} years, {len(df)} rows")
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        # the modules use paths relative to the repository root
+        os.chdir(folder)
+        os.makedirs("data")
+        write_data_files(df)
+        del df
+        nbcn_data.write_dataset()
+        store.write_mapped_file(store.get_data_version())
+        env = dict(os.environ, PYTHONPATH=root)
+        for mode in MODES:
+            output = subprocess.run(
+                [sys.executable, "-m", "benchmarks.bench_memory", "--probe", mode],
+                capture_output=True,
+                text=True,
+                check=True,
+                env=env,
+            ).stdout
+            results[mode] = json.loads(output.strip().splitlines()[-1])
+        os.chdir(root)
+
+    print(f"\n{'':<24}" + "".join(f"{mode:>12}" for mode in MODES))
+    for name in results[MODES[0]]:
+        unit = "" if "MB" in name else "s"
+        values = [f"{results[mode][name]:.3f}{unit}" for mode in MODES]
+        print(f"{name:<24}" + "".join(f"{x:>12}" for x in values))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Compares the legacy per-column clean_data routine with the typed pyarrow
+parser nbcn_data.read_station_file on synthetic NBCN station files.
+
+Run from the repository root: python -m benchmarks.bench_parse
+"""
+
+import timeit
+import numpy as np
+import pandas as pd
+from io import BytesIO
+
+from nbcn_data import read_station_file
+from benchmarks.synthetic import make_station_csv
+
+STATIONS = 5
+YEARS = 160
+REPEAT = 3
+
+
+def legacy_clean_data(df: pd.DataFrame):
+    df.rename(columns={"station/location": "Station", "date": "Date"}, inplace=True)
+    df["Date"] = df["Date"].astype(str)
+    df["Date"] = pd.to_datetime(df["Date"], format="%Y%m%d")
+    cols = df.columns.drop(["Station", "Date"])
+    for col in cols:
+        df[col] = df[col].replace("-", np.nan)
+        df[col] = df[col].astype(float)
+    df["day"] = df["Date"].dt.dayofyear
+    df["month"] = df["Date"].dt.month
+    df["week"] = df["Date"].dt.isocalendar().week
+    df["year"] = df["Date"].dt.year
+    df["decade"] = (df["year"] // 10) * 10
+    return df
+
+
+def main():
+    files = [make_station_csv(f"S{i:02d}", YEARS, i) for i in range(STATIONS)]
+    mb = sum(len(x) for x in files) / 1024**2
+    print(f"{STATIONS} stations x {YEARS} years, {mb:.1f} Mb csv")
+
+    def run_legacy():
+        for content in files:
+            legacy_clean_data(pd.read_csv(BytesIO(content), sep=";"))
+
+    def run_typed():
+        for content in files:
+            read_station_file(BytesIO(content))
+
+    for name, func in [("legacy clean_data", run_legacy), ("typed", run_typed)]:
+        seconds = min(timeit.repeat(func, number=1, repeat=REPEAT))
+        print(f"{name:<20} {seconds:.3f}s")
+
+
+if __name__ == "__main__":
+    main()
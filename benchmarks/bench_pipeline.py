@@ -0,0 +1,131 @@
+"""
+Benchmarks the data and aggregation pipeline on synthetic NBCN data
+(benchmarks/synthetic.py) at a configurable scale of stations x years: station
+file parsing, ingest, filtered reads, aggregation and the preparation steps
+of the summary table, the time series and the 3D spiral. The data folder is
+built in a temporary directory, no network access is needed.
+
+Results can be saved and compared with a saved run, the script exits with
+status 1 if a step is slower than the saved run by more than the threshold.
+
+Run from the repository root:
+    python -m benchmarks.bench_pipeline --stations 29 --years 160 --save base.json
+    python -m benchmarks.bench_pipeline --stations 29 --years 160 --compare base.json
+"""
+
+import os
+import sys
+import json
+import timeit
+import argparse
+import tempfile
+from io import BytesIO
+
+import nbcn_data
+from nbcn_data import STORAGE_SPECS, read_station_file
+from helper import reduce_memory_usage, compact_dtypes, add_date_column
+from plots import get_spiral_data
+from nbcn import SPIRAL_PERIODS, SPIRAL_MAX_POINTS
+from benchmarks.synthetic import make_daily_data, make_station_csv, write_data_files
+
+# differences below this are noise, whatever the ratio
+MIN_SECONDS = 0.005
+
+
+def get_cases(df, stations: list, min_year: int, max_year: int):
+    """Returns (name, function, repeat) of the benchmarked steps."""
+    csv_content = make_station_csv("S00", max_year - min_year + 1)
+    filters = {"stations": stations[:3], "years": [max_year - 29, max_year]}
+    month_df = nbcn_data.get_aggregated_data(
+        {}, ["tre200d0"], "month", min_year, max_year, update=False
+    )
+    spiral_df = month_df[month_df["station"] == stations[0]].sort_values(
+        by=["year", "month"]
+    )
+    spiral_df = spiral_df.rename(columns={"tre200d0": "value"})
+    spiral_settings = {"month": "month", "year": "year", "value": "value"}
+    spiral_settings.update({"period": SPIRAL_PERIODS["month"], "y_domain": [-10, 30]})
+    spiral_settings["max_points"] = SPIRAL_MAX_POINTS
+
+    def aggregate(time_aggregation, filters={}):
+        return lambda: nbcn_data.get_aggregated_data(
+            filters, ["tre200d0"], time_aggregation, min_year, max_year, update=False
+        )
+
+    def summary_table():
+        agg_funcs = ["min", "max", "mean", "std"]
+        month_df.groupby(["station"], observed=True)[["tre200d0"]].agg(agg_funcs)
+
+    return [
+        ("read_station_file", lambda: read_station_file(BytesIO(csv_content)), 3),
+        ("reduce_memory_usage", lambda: reduce_memory_usage(df.copy(), False), 3),
+        ("compact_dtypes", lambda: compact_dtypes(df.copy(), STORAGE_SPECS, False), 3),
+        ("write_dataset", nbcn_data.write_dataset, 1),
+        ("filter_base_data", lambda: nbcn_data.read_filtered_data(filters), 3),
+        ("get_aggregated_data day", aggregate("day", filters), 3),
+        ("get_aggregated_data month", aggregate("month"), 3),
+        ("get_aggregated_data year", aggregate("year", filters), 3),
+        ("summary table groupby", summary_table, 3),
+        ("add_date_column month", lambda: add_date_column(month_df.copy(), "month"), 3),
+        ("get_spiral_data", lambda: get_spiral_data(spiral_df, spiral_settings), 3),
+    ]
+
+
+def compare(results: dict, file: str, threshold: float):
+    """Prints the ratio to the saved results, returns the names of regressions."""
+    with open(file, "r", encoding="utf-8") as f:
+        saved = json.load(f)["results"]
+    regressions = []
+    print(f"\n{'step':<28} {'saved':>9} {'now':>9} {'ratio':>6}")
+    for name, seconds in results.items():
+        if name not in saved:
+            continue
+        ratio = seconds / saved[name]
+        slower = ratio > threshold and seconds - saved[name] > MIN_SECONDS
+        if slower:
+            regressions.append(name)
+        flag = " REGRESSION" if slower else ""
+        print(f"{name:<28} {saved[name]:8.4f}s {seconds:8.4f}s {ratio:6.2f}{flag}")
+    return regressions
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Benchmarks the data pipeline.")
+    parser.add_argument("--stations", type=int, default=10)
+    parser.add_argument("--years", type=int, default=60)
+    parser.add_argument("--save", help="json file the results are written to")
+    parser.add_argument("--compare", help="json file of a saved run")
+    parser.add_argument("--threshold", type=float, default=1.25)
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    save_file = os.path.abspath(args.save) if args.save else None
+    compare_file = os.path.abspath(args.compare) if args.compare else None
+    df = make_daily_data(args.stations, args.years)
+    stations = sorted(df["station"].unique())
+    min_year, max_year = int(df["year"].min()), int(df["year"].max())
+    print(f"{args.stations} stations x {args.years} years, {len(df)} rows")
+
+    results = {}
+    with tempfile.TemporaryDirectory() as folder:
+        # the modules use paths relative to the repository root
+        os.chdir(folder)
+        os.makedirs("data")
+        write_data_files(df)
+        nbcn_data.write_dataset()
+        for name, func, repeat in get_cases(df, stations, min_year, max_year):
+            results[name] = min(timeit.repeat(func, number=1, repeat=repeat))
+            print(f"{name:<28} {results[name]:.4f}s")
+
+    if save_file:
+        with open(save_file, "w", encoding="utf-8") as f:
+            scale = {"stations": args.stations, "years": args.years}
+            json.dump({"scale": scale, "results": results}, f, indent=2)
+    if compare_file and compare(results, compare_file, args.threshold):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+"""
+Compares the preparation time of the 3D spiral coordinates: the former
+iterrows loop writing each cell with df.loc against the vectorized
+plots.get_spiral_data, for a 200 year monthly series and a daily series
+decimated to nbcn.SPIRAL_MAX_POINTS points.
+
+Run from the repository root: python -m benchmarks.bench_spiral
+"""
+
+import timeit
+import numpy as np
+import pandas as pd
+
+from plots import get_spiral_data
+from nbcn import SPIRAL_MAX_POINTS
+
+YEARS = 200
+REPEAT = 3
+
+
+def make_series(freq: str, years: int):
+    dates = pd.date_range(end="2022-12-31", periods=years * 366, freq="D")
+    dates = dates[dates.year > 2022 - years]
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({"date": dates, "value": rng.normal(10, 5, len(dates))})
+    df["year"] = df["date"].dt.year
+    df["month"] = df["date"].dt.month
+    df["day"] = df["date"].dt.dayofyear
+    if freq == "month":
+        df = df.groupby(["year", "month"])["value"].mean().reset_index()
+    return df
+
+
+def legacy_spiral_data(df, settings):
+    def value_to_xy(value, month):
+        v = value - settings["y_domain"][0]
+        origin = (np.abs(settings["y_domain"][0]) + settings["y_domain"][1]) / 2
+        theta_radians = 2 * np.pi / 12 * (month - 1)
+        x = origin + v * np.cos(theta_radians)
+        y = origin + v * np.sin(theta_radians)
+        return x, y
+
+    df["x"] = 0
+    df["y"] = 0
+    df["z"] = 0
+    for index, row in df.iterrows():
+        x, y = value_to_xy(row[settings["value"]], row[settings["month"]])
+        z = row[settings["year"]] + row[settings["month"]] / 12
+        df.loc[index, "x"] = x
+        df.loc[index, "y"] = y
+        df.loc[index, "z"] = z
+    df["text"] = (
+        df[settings["year"]].map(str)
+        + "/"
+        + df[settings["month"]].map(str)
+        + ": "
+        + df[settings["value"]].round(1).map(str)
+        + " °C"
+    )
+    return df
+
+
+def main():
+    settings = {"month": "month", "year": "year", "value": "value"}
+    settings["y_domain"] = [-10, 30]
+    monthly_df = make_series("month", YEARS)
+    daily_df = make_series("day", YEARS)
+    daily_settings = dict(settings, month="day", period=366)
+    daily_settings["max_points"] = SPIRAL_MAX_POINTS
+
+    runs = [
+        (f"legacy, {len(monthly_df)} months", legacy_spiral_data, monthly_df, settings),
+        (
+            f"vectorized, {len(monthly_df)} months",
+            get_spiral_data,
+            monthly_df,
+            settings,
+        ),
+        (
+            f"vectorized, {len(daily_df)} days decimated",
+            get_spiral_data,
+            daily_df,
+            daily_settings,
+        ),
+    ]
+    for name, func, df, run_settings in runs:
+        seconds = min(
+            timeit.repeat(
+                lambda: func(df.copy(), run_settings), number=1, repeat=REPEAT
+            )
+        )
+        print(f"{name:<40} {seconds:.4f}s")
+
+
+if __name__ == "__main__":
+    main()
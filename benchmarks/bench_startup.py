@@ -0,0 +1,62 @@
+"""
+Measures the cold import time of the app modules, each in a fresh python
+process, and lists the slowest modules imported by app.py. folium and scipy
+should not show up, they are imported by the pages using them (plotly is
+imported by streamlit itself).
+
+Run from the repository root: python -m benchmarks.bench_startup
+"""
+
+import sys
+import subprocess
+
+MODULES = ["helper", "nbcn_data", "plots", "trend", "nbcn", "app"]
+REPEAT = 3
+TOP_MODULES = 15
+
+
+def get_import_seconds(module: str):
+    code = f"import time; t = time.perf_counter(); import {module}; "
+    code += "print(time.perf_counter() - t)"
+    seconds = []
+    for _ in range(REPEAT):
+        result = subprocess.run(
+            [sys.executable, "-c", code], capture_output=True, text=True, check=True
+        )
+        seconds.append(float(result.stdout.strip().splitlines()[-1]))
+    return min(seconds)
+
+
+def get_import_times(module: str):
+    """Returns (cumulative microseconds, module) of the modules imported by module."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        times.append((int(cumulative), name.rstrip()))
+    return sorted(times, reverse=True)
+
+
+def main():
+    for module in MODULES:
+        print(f"import {module:<20} {get_import_seconds(module):.3f}s")
+    print("\nslowest modules imported by app:")
+    for cumulative, name in get_import_times("app")[:TOP_MODULES]:
+        print(f"{cumulative / 1e6:8.3f}s {name}")
+    heavy = [
+        x.strip()
+        for _, x in get_import_times("app")
+        if x.strip() in ("folium", "scipy")
+    ]
+    print(f"\nheavy packages imported at startup: {heavy or 'none'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+"""
+Synthetic NBCN daily data in the layout of nbcn_data.read_station_file: station,
+date, the parameters and the calendar columns. Values follow a seasonal cycle
+with noise and are rounded to the published decimal, a share of the values is
+missing. Used by the benchmarks, no network access is needed.
+"""
+
+import numpy as np
+import pandas as pd
+
+import snapshots
+from nbcn_data import PARAMETERS
+
+LAST_DATE = "2022-12-31"
+MISSING_SHARE = 0.02
+
+
+def get_parameter_values(par: str, season: np.ndarray, rng):
+    """Returns plausible daily values of par, season is -1 in winter, 1 in summer."""
+    n = len(season)
+    temperature = 8 + 10 * season + rng.normal(0, 3, n)
+    values = {
+        "gre000d0": 160 + 120 * season + rng.normal(0, 40, n),
+        "hto000d0": np.where(season < -0.5, rng.exponential(10, n), 0),
+        "nto000d0": rng.uniform(0, 100, n),
+        "prestad0": rng.normal(960, 8, n),
+        "rre150d0": np.where(rng.random(n) < 0.5, rng.exponential(6, n), 0),
+        "sre000d0": np.clip(6 + 4 * season + rng.normal(0, 3, n), 0, 15),
+        "tre200d0": temperature,
+        "tre200dn": temperature - rng.uniform(2, 8, n),
+        "tre200dx": temperature + rng.uniform(2, 8, n),
+        "ure200d0": np.clip(rng.normal(75, 10, n), 20, 100),
+    }[par]
+    return np.round(np.clip(values, -999, 3000), 1)
+
+
+def make_station_data(station: str, years: int, seed: int = 0):
+    """Returns the daily data of one station for the years ending with LAST_DATE."""
+    last_date = pd.Timestamp(LAST_DATE)
+    dates = pd.date_range(f"{last_date.year - years + 1}-01-01", last_date, freq="D")
+    rng = np.random.default_rng(seed)
+    season = -np.cos(2 * np.pi * (dates.dayofyear.to_numpy() - 15) / 365.25)
+    df = pd.DataFrame({"station": station, "date": dates})
+    for par in PARAMETERS:
+        values = get_parameter_values(par, season, rng)
+        values[rng.random(len(dates)) < MISSING_SHARE] = np.nan
+        df[par] = values
+    df["day"] = dates.dayofyear.astype("int32")
+    df["month"] = dates.month.astype("int32")
+    df["week"] = dates.isocalendar().week.to_numpy().astype("uint32")
+    df["year"] = dates.year.astype("int32")
+    df["decade"] = (df["year"] // 10 * 10).astype("int32")
+    return df
+
+
+def make_daily_data(stations: int, years: int, seed: int = 0):
+    """Returns the daily data of stations x years, stations are named S00, S01..."""
+    return pd.concat(
+        [make_station_data(f"S{i:02d}", years, seed + i) for i in range(stations)],
+        ignore_index=True,
+    )
+
+
+def make_station_csv(station: str, years: int, seed: int = 0):
+    """Returns the content of a station file in the NBCN daily csv format."""
+    df = make_station_data(station, years, seed)
+    df = df[["station", "date"] + PARAMETERS].rename(
+        columns={"station": "station/location"}
+    )
+    df["date"] = df["date"].dt.strftime("%Y%m%d")
+    return df.to_csv(sep=";", index=False, na_rep="-").encode("utf-8")
+
+
+def write_data_files(df: pd.DataFrame):
+    """Writes df to the previous and current snapshots of the data folder, the
+    last year is the current data."""
+    last_year = df["year"].max()
+    snapshots.write_snapshot("previous", df[df["year"] < last_year])
+    snapshots.write_snapshot("current", df[df["year"] == last_year])
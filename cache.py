@@ -0,0 +1,170 @@
+import os
+import json
+import shutil
+import hashlib
+import threading
+import pandas as pd
+from collections import OrderedDict
+
+CACHE_DIR = "./data/cache"
+# the least recently used results are removed once a cache folder exceeds this size
+MAX_CACHE_BYTES = 50 * 1024**2
+# size of the in-memory query cache shared by all sessions of the process
+MAX_QUERY_CACHE_BYTES = int(os.environ.get("NBCN_QUERY_CACHE_MB", 256)) * 1024**2
+# filter keys changing the data read, see store.get_filter_expression. The
+# single station of the spiral filter is applied by the view to the result
+QUERY_FILTER_KEYS = ["stations", "year", "years", "decades", "month", "months"]
+QUERY_FILTER_KEYS += ["region"]
+
+# key -> (DataFrame, bytes), the least recently used entry first
+query_results = OrderedDict()
+query_lock = threading.Lock()
+query_stats = {"hits": 0, "misses": 0, "evictions": 0, "bytes": 0}
+
+
+def get_key(*args):
+    """Returns a hash of the json representation of args, e.g. parameter and filter."""
+    text = json.dumps(args, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+def get_cache_file(name: str, key: str):
+    return os.path.join(CACHE_DIR, name, f"{key}.parquet")
+
+
+def read_result(name: str, key: str):
+    """
+    Returns the cached DataFrame for key or None if it is not cached. The file
+    modification time is set to now, so the eviction is least recently used.
+
+    :param name: name of the cache, e.g. trend
+    :param key: key as returned by get_key
+    """
+    cache_file = get_cache_file(name, key)
+    if not os.path.exists(cache_file):
+        return None
+    os.utime(cache_file)
+    return pd.read_parquet(cache_file)
+
+
+def write_result(name: str, key: str, df: pd.DataFrame):
+    """
+    Writes df to the cache and removes the least recently used results if the
+    cache is larger than MAX_CACHE_BYTES.
+
+    :param name: name of the cache, e.g. trend
+    :param key: key as returned by get_key
+    :param df: result to be cached
+    """
+    cache_file = get_cache_file(name, key)
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    # write to a temporary file first, so concurrent sessions never read a partial file
+    temp_file = f"{cache_file}.{os.getpid()}.tmp"
+    df.to_parquet(temp_file, index=False, engine="pyarrow")
+    os.replace(temp_file, cache_file)
+    evict(name)
+
+
+def evict(name: str, max_bytes: int = MAX_CACHE_BYTES):
+    cache_dir = os.path.join(CACHE_DIR, name)
+    files = []
+    for file in os.listdir(cache_dir):
+        if file.endswith(".parquet"):
+            stat = os.stat(os.path.join(cache_dir, file))
+            files.append((stat.st_mtime, stat.st_size, file))
+    total_bytes = sum(x[1] for x in files)
+    for mtime, size, file in sorted(files):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache_dir, file))
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+
+
+def clear(name: str = None):
+    """Removes all results of cache name, or of all caches and the query
+    cache if name is None."""
+    cache_dir = CACHE_DIR if name is None else os.path.join(CACHE_DIR, name)
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    if name is None:
+        clear_query_results()
+
+
+def normalize_filters(filters: dict):
+    """
+    Returns the filters changing the data read in a canonical form: empty
+    filters are dropped, lists are sorted. Display options and the value
+    filter, which the views apply to the result, are not part of it.
+    """
+    normalized = {}
+    for key in QUERY_FILTER_KEYS:
+        value = filters.get(key)
+        if value is None or (isinstance(value, (list, tuple)) and len(value) == 0):
+            continue
+        if key in ("stations", "months", "region"):
+            value = sorted(value)
+        normalized[key] = value
+    return normalized
+
+
+def get_query_key(
+    name: str, parameters: list, time_aggregation: str, filters: dict, *args
+):
+    """
+    Returns the key of a query: the data function, parameters, time
+    aggregation, normalized filters and further arguments such as columns.
+
+    :param name: name of the data function
+    :param parameters: selected parameters
+    :param time_aggregation: day, week, month, year or decade
+    :param filters: filter dict as returned by show_filter
+    """
+    return get_key(
+        name, sorted(parameters), time_aggregation, normalize_filters(filters), *args
+    )
+
+
+def get_query_result(key: str, compute):
+    """
+    Returns the result of the query key from the in-memory cache, compute()
+    is only called on a miss. The least recently used results are removed
+    once the cached frames exceed MAX_QUERY_CACHE_BYTES. A copy is returned,
+    so views can modify the frame.
+
+    :param key: key as returned by get_query_key, including the data version
+    :param compute: function returning the DataFrame of the query
+    :return: DataFrame
+    """
+    with query_lock:
+        if key in query_results:
+            query_results.move_to_end(key)
+            query_stats["hits"] += 1
+            return query_results[key][0].copy()
+        query_stats["misses"] += 1
+    # computed outside the lock, two sessions may compute the same query once
+    df = compute()
+    size = int(df.memory_usage(deep=True).sum())
+    with query_lock:
+        if key not in query_results:
+            query_results[key] = (df, size)
+            query_stats["bytes"] += size
+        while query_stats["bytes"] > MAX_QUERY_CACHE_BYTES and len(query_results) > 1:
+            _, (_, evicted_size) = query_results.popitem(last=False)
+            query_stats["bytes"] -= evicted_size
+            query_stats["evictions"] += 1
+    return df.copy()
+
+
+def clear_query_results():
+    with query_lock:
+        query_results.clear()
+        query_stats["bytes"] = 0
+
+
+def get_query_stats():
+    """Returns the hits, misses, evictions, bytes and entries of the query cache."""
+    with query_lock:
+        return dict(query_stats, entries=len(query_results))
@@ -0,0 +1,151 @@
+import os
+import pandas as pd
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import store
+import aggregates
+
+NORMALS_FILE = "climate-data-ncbn-normals-{}.parquet"
+ANOMALIES_FILE = "climate-data-ncbn-anomalies-{}.parquet"
+# WMO standard reference periods
+REFERENCE_PERIODS = {"1961-1990": (1961, 1990), "1991-2020": (1991, 2020)}
+# a normal needs values in at least 80% of the years of the reference period
+MIN_NORMAL_YEARS = 24
+# group keys of the normals, the anomalies are stored for month and year. Daily
+# normals are keyed by calendar day, the day of the year shifts by one after
+# Feb 28 in leap years
+NORMAL_KEYS = {
+    "day": ["station", "month", "day_of_month"],
+    "month": ["station", "month"],
+    "year": ["station"],
+}
+ANOMALY_KEYS = {"month": ["station", "year", "month"], "year": ["station", "year"]}
+
+
+def get_normals_file(time_aggregation: str, folder: str = None):
+    return store.get_derived_file(NORMALS_FILE.format(time_aggregation), folder)
+
+
+def get_anomalies_file(time_aggregation: str, folder: str = None):
+    return store.get_derived_file(ANOMALIES_FILE.format(time_aggregation), folder)
+
+
+def tables_exist():
+    files = [get_normals_file(x) for x in NORMAL_KEYS]
+    files += [get_anomalies_file(x) for x in ANOMALY_KEYS]
+    return all(os.path.exists(x) for x in files)
+
+
+def build_normals(df: pd.DataFrame, time_aggregation: str, parameters: list):
+    """
+    Calculates the normals of each reference period: the mean of the daily,
+    monthly or yearly values over the years of the period. Normals based on
+    less than MIN_NORMAL_YEARS years are set to NaN. Feb 29 occurs in a
+    quarter of the years only, it gets the daily normal of Feb 28.
+
+    :param df: daily values with a date column or the month or year cube, with
+               a year column
+    :param time_aggregation: day, month or year
+    :param parameters: parameters to be included
+    :return: DataFrame with station, period, [month, day_of_month or month]
+             and the parameters
+    """
+    keys = NORMAL_KEYS[time_aggregation]
+    if time_aggregation == "day":
+        df = df.assign(month=df["date"].dt.month, day_of_month=df["date"].dt.day)
+        df = df[~((df["month"] == 2) & (df["day_of_month"] == 29))]
+    normals = []
+    for period, (first_year, last_year) in REFERENCE_PERIODS.items():
+        period_df = df[(df["year"] >= first_year) & (df["year"] <= last_year)]
+        grouped = period_df.groupby(keys, observed=True)[parameters]
+        normal_df = grouped.mean().where(grouped.count() >= MIN_NORMAL_YEARS)
+        normal_df = normal_df.reset_index()
+        normal_df.insert(1, "period", period)
+        normals.append(normal_df)
+    normals = pd.concat(normals, ignore_index=True)
+    if time_aggregation == "day":
+        feb_28 = (normals["month"] == 2) & (normals["day_of_month"] == 28)
+        normals = pd.concat([normals, normals[feb_28].assign(day_of_month=29)])
+        normals = normals.sort_values(by=["station", "period"] + keys[1:])
+        normals = normals.reset_index(drop=True)
+    return normals
+
+
+def build_anomalies(cube: pd.DataFrame, normals: pd.DataFrame, time_aggregation: str):
+    """
+    Subtracts the normal of each reference period from the monthly or yearly
+    values.
+
+    :param cube: month or year cube, see aggregates.build_cube
+    :param normals: normals of the same time aggregation, see build_normals
+    :param time_aggregation: month or year
+    :return: DataFrame with station, period, year, [month], decade and the
+             anomalies of the parameters
+    """
+    keys = NORMAL_KEYS[time_aggregation]
+    parameters = [x for x in normals.columns if x not in keys + ["period"]]
+    anomalies = []
+    for period in REFERENCE_PERIODS:
+        normal_df = normals[normals["period"] == period]
+        merged_df = cube.merge(normal_df, on=keys, how="inner", suffixes=("", "_n"))
+        anomaly_df = merged_df[ANOMALY_KEYS[time_aggregation] + ["decade"]].copy()
+        anomaly_df.insert(1, "period", period)
+        for par in parameters:
+            anomaly_df[par] = merged_df[par] - merged_df[f"{par}_n"]
+        anomalies.append(anomaly_df)
+    return pd.concat(anomalies, ignore_index=True)
+
+
+def write_tables(
+    df: pd.DataFrame, parameters: list, folder: str, daily_normals: bool = True
+):
+    """
+    Writes the normals and the monthly and yearly anomalies. The monthly and
+    yearly tables are built from the aggregate cubes, so aggregates.write_cubes
+    must run first.
+
+    :param df: daily data, used for the daily normals
+    :param parameters: parameters to be included
+    :param folder: dataset directory, see store.create_staging_dir
+    :param daily_normals: if False, the daily normals are kept, e.g. when df
+                          only holds the current decades
+    """
+    day_file = get_normals_file("day", folder)
+    # daily normals written by day of the year are rebuilt
+    if (
+        daily_normals
+        or not os.path.exists(day_file)
+        or "day_of_month" not in pq.read_schema(day_file).names
+    ):
+        normals = build_normals(df, "day", parameters)
+        store.write_parquet(normals, day_file)
+    for time_aggregation in ANOMALY_KEYS:
+        cube = pd.read_parquet(aggregates.get_cube_file(time_aggregation, folder))
+        normals = build_normals(cube, time_aggregation, parameters)
+        store.write_parquet(normals, get_normals_file(time_aggregation, folder))
+        anomalies = build_anomalies(cube, normals, time_aggregation)
+        store.write_parquet(anomalies, get_anomalies_file(time_aggregation, folder))
+
+
+def read_anomalies(time_aggregation: str, period: str, filters: dict, parameters: list):
+    """
+    Reads the monthly or yearly anomalies for the reference period matching
+    filters.
+
+    :param time_aggregation: month or year
+    :param period: key of REFERENCE_PERIODS
+    :param filters: filter dict as returned by show_filter
+    :param parameters: parameters to be read
+    :return: DataFrame with station, year, [month] and the anomalies
+    """
+    if time_aggregation == "year":
+        filters = {k: v for k, v in filters.items() if k not in ("month", "months")}
+    expression = ds.field("period") == period
+    filter_expression = store.get_filter_expression(filters)
+    if filter_expression is not None:
+        expression = expression & filter_expression
+    dataset = ds.dataset(get_anomalies_file(time_aggregation), format="parquet")
+    columns = ANOMALY_KEYS[time_aggregation] + parameters
+    df = dataset.to_table(columns=columns, filter=expression).to_pandas()
+    return df.dropna(subset=parameters, how="all")
@@ -0,0 +1,45 @@
+import gzip
+import hashlib
+import streamlit as st
+import pandas as pd
+from io import BytesIO
+
+# file extension and mime type of the download formats
+EXPORT_FORMATS = {
+    "csv": (".csv", "text/csv"),
+    "csv.gz": (".csv.gz", "application/gzip"),
+    "parquet": (".parquet", "application/vnd.apache.parquet"),
+}
+
+
+def get_frame_hash(df: pd.DataFrame):
+    """Returns a hash of the columns and values of df, used to key the exports."""
+    values = pd.util.hash_pandas_object(df, index=False).to_numpy().tobytes()
+    columns = str(list(df.columns)).encode("utf-8")
+    return hashlib.sha1(columns + values).hexdigest()
+
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def get_export_data(_df: pd.DataFrame, frame_hash: str, export_format: str):
+    """
+    Encodes df in export_format. The result is cached by frame_hash, so the
+    frame itself is not hashed by streamlit and each export is only built once.
+
+    :param _df: data to be exported
+    :param frame_hash: hash as returned by get_frame_hash
+    :param export_format: key of EXPORT_FORMATS
+    :return: bytes of the file
+    """
+    if export_format == "parquet":
+        buffer = BytesIO()
+        _df.to_parquet(buffer, index=False, engine="pyarrow")
+        return buffer.getvalue()
+    data = _df.to_csv(index=False).encode("utf-8")
+    if export_format == "csv.gz":
+        data = gzip.compress(data)
+    return data
+
+
+def get_file_name(file_name: str, export_format: str):
+    base_name = file_name.split(".")[0]
+    return base_name + EXPORT_FORMATS[export_format][0]
@@ -9,6 +9,8 @@ import random
 import pandas as pd
 import numpy as np
 
+import export
+
 LOCAL_HOST = "liestal"
 DEV_MACHINES = [LOCAL_HOST]
 
@@ -31,12 +33,9 @@ def reduce_memory_usage(df, verbose=True):
                 elif c_min > np.iinfo(np.int64).min and c_max < np.iinfo(np.int64).max:
                     df[col] = df[col].astype(np.int64)
             else:
+                # float16 is not used: with ~3 significant digits it loses the
+                # published precision of e.g. pressure values around 1000 hPa
                 if (
-                    c_min > np.finfo(np.float16).min
-                    and c_max < np.finfo(np.float16).max
-                ):
-                    df[col] = df[col].astype(np.float16)
-                elif (
                     c_min > np.finfo(np.float32).min
                     and c_max < np.finfo(np.float32).max
                 ):
@@ -53,6 +52,120 @@ def reduce_memory_usage(df, verbose=True):
     return df
 
 
+def encode_column(values: pd.Series, dtype: str, decimals: int):
+    """Converts a float column to dtype and checks the round trip.
+
+    Args:
+        values (pd.Series): float values
+        dtype (str): "int16" for values scaled by 10**decimals and stored as
+                     nullable Int16, or a numpy float type such as "float32"
+        decimals (int): published precision of the values
+
+    Returns:
+        pd.Series: the encoded values or None if the round trip is not exact to
+                   the given decimals or the values are out of range
+    """
+    if dtype == "int16":
+        scaled = values * 10**decimals
+        int_info = np.iinfo(np.int16)
+        if scaled.min() < int_info.min or scaled.max() > int_info.max:
+            return None
+        encoded = scaled.round().astype("Int16")
+        decoded = encoded.astype("float64") / 10**decimals
+    else:
+        encoded = values.astype(dtype)
+        decoded = encoded.astype("float64").round(decimals)
+    if not np.allclose(decoded, values, rtol=0, atol=1e-9, equal_nan=True):
+        return None
+    return encoded
+
+
+def compact_dtypes(df: pd.DataFrame, specs: dict, verbose: bool = True):
+    """Converts the columns listed in specs to their compact storage type.
+
+    A spec is a dict with the keys dtype and, for numeric columns, decimals,
+    the precision the values are published with:
+    - {"dtype": "int16", "decimals": 1}: values scaled by 10 stored as Int16
+    - {"dtype": "float32", "decimals": 1}: values stored as float32
+    - {"dtype": "category"}
+    A numeric column is only converted if the round trip is exact to the given
+    decimals, otherwise float32 is tried and if this fails as well, the column
+    is kept as is.
+
+    Args:
+        df (pd.DataFrame): DataFrame with float columns
+        specs (dict): storage spec for each column
+        verbose (bool, optional): prints the report. Defaults to True.
+
+    Returns:
+        tuple: converted DataFrame and a report DataFrame with the source and
+               storage type and the bytes saved for each column
+    """
+    rows = []
+    for col, spec in specs.items():
+        if col not in df.columns:
+            continue
+        row = {"column": col, "source": str(df[col].dtype)}
+        row["bytes_before"] = df[col].memory_usage(index=False, deep=True)
+        if spec["dtype"] == "category":
+            df[col] = df[col].astype("category")
+        else:
+            for dtype in dict.fromkeys([spec["dtype"], "float32"]):
+                encoded = encode_column(df[col], dtype, spec["decimals"])
+                if encoded is not None:
+                    df[col] = encoded
+                    break
+        row["storage"] = str(df[col].dtype)
+        row["bytes_after"] = df[col].memory_usage(index=False, deep=True)
+        row["bytes_saved"] = row["bytes_before"] - row["bytes_after"]
+        rows.append(row)
+    report = pd.DataFrame(
+        rows,
+        columns=["column", "source", "storage", "bytes_before", "bytes_after"]
+        + ["bytes_saved"],
+    )
+    if verbose:
+        print(report.to_string(index=False))
+        print(
+            "Mem. usage of compacted columns decreased by {:.2f} Mb".format(
+                report["bytes_saved"].sum() / 1024**2
+            )
+        )
+    return df, report
+
+
+def decode_dtypes(df: pd.DataFrame, specs: dict):
+    """Reverts compact_dtypes for computation: scaled integer columns are
+    converted back to float32 values, category columns are restored.
+
+    Args:
+        df (pd.DataFrame): DataFrame with columns in their storage type
+        specs (dict): storage spec for each column, see compact_dtypes
+
+    Returns:
+        pd.DataFrame: DataFrame with float32 parameter columns
+    """
+    for col, spec in specs.items():
+        if col not in df.columns:
+            continue
+        if spec["dtype"] == "category":
+            if df[col].dtype != "category":
+                df[col] = df[col].astype("category")
+        elif pd.api.types.is_integer_dtype(df[col].dtype):
+            df[col] = df[col].astype("float32") / np.float32(10 ** spec["decimals"])
+    return df
+
+
+@st.cache_resource(show_spinner=False)
+def load_lang_file(lang_file: str) -> dict:
+    """
+    Reads a language file once per process, the returned dictionary is shared
+    by all sessions and must not be modified.
+    """
+    with open(lang_file, "r") as file:
+        return json.load(file)
+
+
 def init_lang_dict_complete(module: str, key: str):
     """
     Retrieves the complete language dictionary from a JSON file.
@@ -62,8 +175,7 @@ def init_lang_dict_complete(module: str, key: str):
     """
     lang_file = f"./lang/{module.replace('.py','.json')}"
     try:
-        with open(lang_file, "r") as file:
-            st.session_state["lang_dict"][key] = json.load(file)
+        st.session_state["lang_dict"][key] = load_lang_file(lang_file)
     except FileNotFoundError:
         print("File not found.")
         return {}
@@ -236,18 +348,43 @@ def randomword(length):
 
 
 def show_download_button(df: pd.DataFrame, cfg: dict = {}):
-    if "filename" not in cfg:
-        cfg["filename"] = "file.csv"
-    key = randomword(10)
+    """Shows a download button for df. The file is only encoded once the user
+    asks for it: the first click shows the format (csv, compressed csv or
+    parquet) and the download button, the files are cached by the content
+    hash of df, see export.get_export_data.
 
-    csv = df.to_csv(index=False).encode("utf-8")
-    st.download_button(
-        label=cfg["button_text"],
-        data=csv,
-        file_name=cfg["filename"],
-        mime="text/csv",
-        key=key,
-    )
+    Args:
+        df (pd.DataFrame): data to be downloaded
+        cfg (dict): button_text, optional filename and key, the key is needed
+            if a page shows more than one button, e.g. one per station
+    """
+
+    def request_export():
+        st.session_state[key] = True
+
+    file_name = cfg.get("filename", "file.csv")
+    frame_hash = export.get_frame_hash(df)
+    key = f"export_{cfg.get('key', '')}_{frame_hash}"
+    if not st.session_state.get(key, False):
+        st.button(cfg["button_text"], key=f"{key}_request", on_click=request_export)
+        return
+
+    cols = st.columns([1, 3])
+    with cols[0]:
+        export_format = st.selectbox(
+            "Format",
+            options=list(export.EXPORT_FORMATS.keys()),
+            key=f"{key}_format",
+            label_visibility="collapsed",
+        )
+    with cols[1]:
+        st.download_button(
+            label=cfg["button_text"],
+            data=export.get_export_data(df, frame_hash, export_format),
+            file_name=export.get_file_name(file_name, export_format),
+            mime=export.EXPORT_FORMATS[export_format][1],
+            key=f"{key}_download",
+        )
 
 
 def round_to_nearest(value, base):
@@ -290,3 +427,27 @@ def add_date_column(df: pd.DataFrame, agg_type: str):
         )
 
     return df
+
+
+def get_station_slices(df: pd.DataFrame, column: str = "station"):
+    """Splits df into the rows of each station. df is sorted by station once
+    (not at all if it is already sorted) and each station is a row range of
+    the sorted frame, instead of a boolean scan of all rows per station.
+
+    Args:
+        df (pd.DataFrame): DataFrame with a station column
+        column (str, optional): name of the station column
+
+    Returns:
+        dict: station -> DataFrame with the rows of the station
+    """
+    codes, stations = pd.factorize(df[column], sort=True)
+    if np.any(np.diff(codes) < 0):
+        order = np.argsort(codes, kind="stable")
+        df = df.iloc[order]
+        codes = codes[order]
+    bounds = np.searchsorted(codes, np.arange(len(stations) + 1))
+    return {
+        station: df.iloc[bounds[i] : bounds[i + 1]]
+        for i, station in enumerate(stations)
+    }
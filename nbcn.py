@@ -1,15 +1,24 @@
 import streamlit as st
 import os
+import time
 import pandas as pd
 import numpy as np
 import math
-import pymannkendall as mk
-from scipy import stats
 from enum import Enum
-from datetime import datetime
 
-from trend import TrendAnalysis
-from nbcn_data import get_data, get_stations_metadata
+import cache
+import store
+from timing import timed
+from climatology import REFERENCE_PERIODS, read_anomalies
+from records import RECORD_SCOPES, RECORD_KINDS, get_records_set
+from trend import TrendAnalysis, seasonal_mann_kendall, TREND_KEYS
+from nbcn_data import (
+    get_filtered_data,
+    get_aggregated_data,
+    get_shared_data,
+    get_stations_metadata,
+    PARAMETERS_AGG_DICT,
+)
 from helper import (
     init_lang_dict_complete,
     get_lang,
@@ -17,6 +26,7 @@ from helper import (
     show_download_button,
     remove_unit,
     add_date_column,
+    get_station_slices,
 )
 from plots import (
     bar_chart,
@@ -31,6 +41,13 @@ from plots import (
 )
 
 MIN_POINTS = 4 * 12
+# positions per turn of the 3D spiral and maximum number of points shown
+SPIRAL_PERIODS = {"day": 366, "week": 53, "month": 12}
+SPIRAL_MAX_POINTS = 5000
+# per-station charts are rendered page by page, a page ends early once the
+# render budget of the rerun is used
+STATIONS_PER_PAGE = int(os.environ.get("NBCN_STATIONS_PER_PAGE", 6))
+RENDER_BUDGET_SECONDS = float(os.environ.get("NBCN_RENDER_BUDGET_SECONDS", 5))
 
 
 class Plot(Enum):
@@ -42,6 +59,8 @@ class Plot(Enum):
     TIME_SERIES = 5
     SPIRAL = 6
     HISTOGRAM = 7
+    ANOMALY_HEATMAP = 8
+    ANOMALY_TIME_SERIES = 9
 
 
 time_aggregation_plots = {
@@ -71,6 +90,8 @@ time_aggregation_plots = {
         Plot.TIME_SERIES.value,
         Plot.SPIRAL.value,
         Plot.HISTOGRAM.value,
+        Plot.ANOMALY_HEATMAP.value,
+        Plot.ANOMALY_TIME_SERIES.value,
     ],
     "year": [
         Plot.SUMMARY_TABLE.value,
@@ -79,6 +100,7 @@ time_aggregation_plots = {
         Plot.HEATMAP.value,
         Plot.TIME_SERIES.value,
         Plot.HISTOGRAM.value,
+        Plot.ANOMALY_TIME_SERIES.value,
     ],
     "decade": [
         Plot.SUMMARY_TABLE.value,
@@ -89,6 +111,8 @@ time_aggregation_plots = {
     ],
 }
 
+# columns of records.get_records_set, translated by lang["record-columns"]
+RECORD_COLUMNS = ["parameter", "key", "value", "date", "value_2", "date_2"]
 RESSOURCES_FILE = "./data/ressources.csv"
 PAGE = __name__
 lang = {}
@@ -104,11 +128,6 @@ class NCBN:
         self.menu_dict = self.get_menu_dict()
         self.menu_options = list(self.menu_dict.values())
         self._menu_selection = list(self.menu_dict.keys())[0]
-        self.raw_data_df = get_data()
-        self._base_data_df = pd.DataFrame()
-        self.station_df = get_stations_metadata()
-        self.stations_dict = self.get_station_dict()
-        self.min_year, self.max_year = self.get_min_max_year(self.raw_data_df)
         self.parameters = []
 
         self.time_aggregation = "month"
@@ -117,6 +136,8 @@ class NCBN:
         self.sel_analysis = None
 
         self.show_average_line = False
+        self.reference_period = list(REFERENCE_PERIODS.keys())[-1]
+        self.record_scope, self.record_kind = RECORD_SCOPES[0], RECORD_KINDS[0]
         self.parameters_dict = {
             "gre000d0": lang["gre000d0"],
             "hto000d0": lang["hto000d0"],
@@ -141,18 +162,7 @@ class NCBN:
             "tre200dx": lang["tre200dx-s"],
             "ure200d0": lang["ure200d0-s"],
         }
-        self.parameters_agg_dict = {
-            "gre000d0": "mean",
-            "hto000d0": "mean",
-            "nto000d0": "mean",
-            "prestad0": "mean",
-            "rre150d0": "sum",
-            "sre000d0": "sum",
-            "tre200d0": "mean",
-            "tre200dn": "min",
-            "tre200dx": "max",
-            "ure200d0": "mean",
-        }
+        self.parameters_agg_dict = PARAMETERS_AGG_DICT
 
     @property
     def menu_selection(self):
@@ -168,7 +178,7 @@ class NCBN:
             config = []
             self.show_stations()
         elif self._menu_selection == "data":
-            config = ["time-aggregation", "parameters", "value"]
+            config = ["time-aggregation", "analysis-options", "parameters", "value"]
             self.show_browse_data(config)
         elif self._menu_selection == "plots":
             self.show_stats()
@@ -177,31 +187,71 @@ class NCBN:
         elif self._menu_selection == "ressources":
             self.show_ressources()
 
+    @property
+    def data(self):
+        """Data shared by all sessions, see nbcn_data.SharedData. It is loaded
+        by the first page using it, the about page is shown without."""
+        return get_shared_data(store.get_data_version())
+
+    @property
+    def station_df(self):
+        """Station metadata, read without loading the daily data, so the about
+        and stations pages do not trigger the data download."""
+        return get_stations_metadata()
+
+    @property
+    def stations_dict(self):
+        return self.data.stations_dict
+
+    @property
+    def min_year(self):
+        return self.data.min_year
+
+    @property
+    def max_year(self):
+        return self.data.max_year
+
     @property
     def par_label_no_unit(self):
         return remove_unit(self.parameters_short_dict[self.parameters[0]])
 
-    def get_aggregated_data(self, df):
-        # generate values aggregated by month
-        # for day-month, the year must be added ot the aggregation parameters
-        if self.time_aggregation in ("week", "month", "day"):
-            group_parameters = ["station", "year", self.time_aggregation]
-        else:
-            group_parameters = ["station", self.time_aggregation]
-        df = (
-            df.groupby(group_parameters)[self.parameters]
-            .agg([self.parameters_agg_dict[self.parameters[0]]])
-            .reset_index()
+    @timed
+    def get_aggregated_data(self, filter, time_aggregation: str = None):
+        """Returns the selected parameters aggregated by station and time
+        aggregation, see nbcn_data.get_aggregated_data.
+
+        Args:
+            filter (dict): filter dict as returned by show_filter
+            time_aggregation (str, optional): defaults to self.time_aggregation
+
+        Returns:
+            pd.DataFrame: station, [year], time aggregation and parameter columns
+        """
+        if time_aggregation is None:
+            time_aggregation = self.time_aggregation
+        # the cubes are read in the version the result is cached for
+        version = store.get_data_version()
+        key = cache.get_query_key(
+            "aggregated", self.parameters, time_aggregation, filter, version
+        )
+        return cache.get_query_result(
+            key,
+            lambda: get_aggregated_data(
+                filter,
+                self.parameters,
+                time_aggregation,
+                self.min_year,
+                self.max_year,
+                version=version,
+            ),
         )
-        # rename parameter back
-        df.columns = group_parameters + self.parameters
-        return df
 
     def get_menu_dict(self):
         menu_values = lang["menu-options-values"]
         menu_keys = ["home", "stations", "data", "plots", "trend", "ressources"]
         return dict(zip(menu_keys, menu_values))
 
+    @timed
     def get_base_data(self, filter, add_fields: list = [], include_date: bool = False):
         if include_date:
             fields = ["station", "date"] + add_fields + self.parameters
@@ -211,11 +261,9 @@ class NCBN:
                 if add_fields
                 else ["station", self.time_aggregation] + self.parameters
             )
-        df = self.filter_base_data(filter)
-        df = df[fields]
-        if len(self.parameters) == 1:
-            df = df.dropna(subset=self.parameters)
-        return df
+        # with a single parameter, the days without a value are skipped on read
+        not_null = self.parameters if len(self.parameters) == 1 else []
+        return self.filter_base_data(filter, columns=fields, not_null=not_null)
 
     def rename_columns(self, df: pd.DataFrame):
         columns = {}
@@ -244,7 +292,9 @@ class NCBN:
     def aggregate(self):
         agg_functions = {par: self.parameters_agg_dict[par] for par in self.parameters}
         df = (
-            df.groupby(["station", self.time_aggregation])[self.parameters]
+            df.groupby(["station", self.time_aggregation], observed=True)[
+                self.parameters
+            ]
             .agg(agg_functions)
             .reset_index()
         )
@@ -276,6 +326,64 @@ class NCBN:
             settings["h_line"] = "_value"
         return settings
 
+    @timed
+    def show_station_pages(self, station_slices: dict, show_station, key: str):
+        """Renders the per-station charts one page at a time. Only the charts of
+        the current page are built and serialized, a page holds
+        STATIONS_PER_PAGE stations and ends early once RENDER_BUDGET_SECONDS
+        are used. The build time of each chart is kept in
+        st.session_state["chart_build_seconds"].
+
+        Args:
+            station_slices (dict): station -> data, see get_station_slices
+            show_station (function): renders the chart of station and its data
+            key (str): name of the view, the page is kept per view
+        """
+
+        def set_first_station(value):
+            st.session_state[page_key] = value
+
+        stations = list(station_slices.keys())
+        page_key = f"first_station_{key}"
+        first = st.session_state.get(page_key, 0)
+        if first >= len(stations):
+            first = 0
+        start_time = time.perf_counter()
+        build_seconds = {}
+        for station in stations[first : first + STATIONS_PER_PAGE]:
+            if time.perf_counter() - start_time > RENDER_BUDGET_SECONDS:
+                st.info(lang["render-budget-used"].format(RENDER_BUDGET_SECONDS))
+                break
+            chart_start = time.perf_counter()
+            show_station(station, station_slices[station])
+            build_seconds[station] = time.perf_counter() - chart_start
+        st.session_state["chart_build_seconds"] = build_seconds
+        if len(stations) == 0:
+            return
+
+        last = first + len(build_seconds)
+        average_ms = 1000 * sum(build_seconds.values()) / max(len(build_seconds), 1)
+        st.caption(
+            lang["stations-page"].format(first + 1, last, len(stations), average_ms)
+        )
+        cols = st.columns(2)
+        with cols[0]:
+            if first > 0:
+                st.button(
+                    lang["previous-stations"],
+                    key=f"{page_key}_previous",
+                    on_click=set_first_station,
+                    args=(max(first - STATIONS_PER_PAGE, 0),),
+                )
+        with cols[1]:
+            if last < len(stations):
+                st.button(
+                    lang["next-stations"],
+                    key=f"{page_key}_next",
+                    on_click=set_first_station,
+                    args=(last,),
+                )
+
     def get_analysis_options(self) -> dict:
         """Removes some analsysis methods from the options, which do not make sense for yearly values
 
@@ -285,6 +393,8 @@ class NCBN:
 
         if self.menu_selection == "trend":
             options = lang["trend-analysis-options"]
+        elif self.menu_selection == "data":
+            options = lang["browse-data-options"]
         else:
             all_options = lang["stats-analysis-options"]
             options = []
@@ -292,16 +402,6 @@ class NCBN:
                 options.append(all_options[option])
         return options
 
-    def get_min_max_year(self, df: pd.DataFrame):
-        """Returns the first and last year of a given dataframe
-
-        Returns:
-            _type_: _description_
-        """
-        min_year = df["year"].min()
-        max_year = df["year"].max()
-        return int(min_year), int(max_year)
-
     def filter_values(self, filters, df):
         if "value" in filters:
             if filters["value"]["use_numeric_filter"]:
@@ -317,37 +417,36 @@ class NCBN:
                     df = df[df[self.parameters[0]] == filters["value"]["value"]]
             return df
 
-    def filter_base_data(self, filters):
-        df = self.raw_data_df
-        if "stations" in filters and filters["stations"] != []:
-            df = df[df["station"].isin(filters["stations"])]
-        if "years" in filters and filters["years"] != []:
-            df = df[
-                (df["year"] >= filters["years"][0])
-                & (df["year"] <= filters["years"][1])
-            ]
+    @timed
+    def filter_base_data(self, filters, columns: list = None, not_null: list = []):
+        """Reads the daily data matching the filters, the filters are pushed
+        down to the store.
+
+        Args:
+            filters (dict): filter dict as returned by show_filter
+            columns (list, optional): columns to be read, all if None.
+            not_null (list, optional): columns whose missing values are skipped
+
+        Returns:
+            pd.DataFrame: filtered daily data
+        """
         # todo: add region filter to the widgets and region filter to data
-        if "year" in filters:
-            df = df[(df["year"] == filters["year"])]
-        if "month" in filters:
-            df = df[(df["month"] == filters["month"])]
-        if "region" in filters and filters["region"] != []:
-            df = df[df["climate region"].isin(filters["region"])]
-        if "months" in filters and filters["months"] != []:
-            df = df[df["month"].isin(filters["months"])]
-        return df
+        if columns is None:
+            columns = store.COLUMNS
+        # the parameters are part of the columns read
+        key = cache.get_query_key(
+            "filtered", [], None, filters, columns, not_null, store.get_data_version()
+        )
+        return cache.get_query_result(
+            key, lambda: get_filtered_data(filters, columns, not_null)
+        )
 
     def get_stat_function_dict(self):
         keys = ["min", "max", "average"]
         values = lang["stat-functions"]
         return dict(zip(keys, values))
 
-    def get_station_dict(self):
-        df = get_stations_metadata().reset_index()
-        keys = list(df["station"])
-        values = list(df["station name"])
-        return dict(zip(keys, values))
-
+    @timed
     def show_summary_table(self):
         def get_filter():
             settings = {"stat_par": "", "stations": [], "years": [], "months": []}
@@ -365,11 +464,7 @@ class NCBN:
                 self.time_aggregation, self.parameters_dict[self.parameters[0]]
             )
         )
-        year_field = (
-            ["year"] if self.time_aggregation in ("day", "week", "month") else []
-        )
-        df = self.get_base_data(get_filter(), add_fields=year_field)
-        df = self.get_aggregated_data(df)
+        df = self.get_aggregated_data(get_filter())
         # calculate statistics
         group_parameters = list(df.columns)
         if self.time_aggregation in ("week", "month", "day"):
@@ -377,7 +472,11 @@ class NCBN:
         group_parameters.remove(self.time_aggregation)
         group_parameters.remove(self.parameters[0])
         agg_funcs = ["min", "max", "mean", "std"]
-        df = df.groupby(group_parameters)[self.parameters].agg(agg_funcs).reset_index()
+        df = (
+            df.groupby(group_parameters, observed=True)[self.parameters]
+            .agg(agg_funcs)
+            .reset_index()
+        )
         df.columns = group_parameters + agg_funcs
         df = self.merge_station_columns(df, ["station name"])
 
@@ -398,6 +497,7 @@ class NCBN:
         )
         show_download_button(df, {"button_text": lang["download_button_text"]})
 
+    @timed
     def show_barchart(self):
         def get_filter():
             settings = {
@@ -419,18 +519,18 @@ class NCBN:
         st.markdown(
             lang["bar_chart_intro"].format(self.parameters_label, lang["intro_plot"])
         )
-        year_field = (
-            ["year"] if self.time_aggregation in ("day", "week", "month") else []
-        )
-        df = self.get_base_data(get_filter(), add_fields=year_field)
-        df = self.get_aggregated_data(df)
+        df = self.get_aggregated_data(get_filter())
         # calculate statistics
         group_parameters = list(df.columns)
         if self.time_aggregation in ("week", "month", "day"):
             group_parameters.remove("year")
         group_parameters.remove(self.parameters[0])
         agg_funcs = ["mean"]
-        df = df.groupby(group_parameters)[self.parameters].agg(agg_funcs).reset_index()
+        df = (
+            df.groupby(group_parameters, observed=True)[self.parameters]
+            .agg(agg_funcs)
+            .reset_index()
+        )
         df.columns = group_parameters + agg_funcs
         par_name = remove_unit(self.parameters_short_dict[self.parameters[0]])
         df.columns = ["station", self.time_aggregation, par_name]
@@ -445,20 +545,26 @@ class NCBN:
         }
         if self.time_aggregation == "year":
             settings["x_domain"] = self.get_domain(df, self.time_aggregation, 1)
-        stations = df["station"].unique()
-        for station in stations:
-            df_filtered = df[(df["station"] == station)]
+
+        def show_station(station, df_filtered):
             if len(df_filtered) > 0:
                 settings["title"] = f"{self.stations_dict[station]} ({station})"
                 settings["bar_width"] = 800 / len(df_filtered) * 0.5
-                settings = self.get_h_line_value(df_filtered, settings)
+                self.get_h_line_value(df_filtered, settings)
                 bar_chart(df_filtered, settings)
                 show_download_button(
-                    df_filtered, {"button_text": lang["download_button_text"]}
+                    df_filtered,
+                    {
+                        "button_text": lang["download_button_text"],
+                        "key": f"barchart_{station}",
+                    },
                 )
             else:
                 st.markdown(lang["no_data"])
 
+        self.show_station_pages(get_station_slices(df), show_station, "barchart")
+
+    @timed
     def show_boxplot(self):
         def get_filter():
             settings = {"stat_par": "", "stations": [], "years": [], "months": []}
@@ -472,11 +578,7 @@ class NCBN:
 
         st.header(lang["boxplot"].format(self.parameters_label))
         st.markdown(lang["intro-box-plot"].format(lang["intro_plot"]))
-        year_field = (
-            ["year"] if self.time_aggregation in ("day", "week", "month") else []
-        )
-        df = self.get_base_data(get_filter(), add_fields=year_field)
-        df = self.get_aggregated_data(df)
+        df = self.get_aggregated_data(get_filter())
         # calculate statistics
         group_parameters = list(df.columns)
         if self.time_aggregation in ("week", "month", "day"):
@@ -490,16 +592,22 @@ class NCBN:
             "y_title": self.parameters_short_dict[self.parameters[0]],
             "x_title": lang[self.time_aggregation],
         }
-        stations = df["station"].unique()
-        for station in stations:
-            df_filtered = df[(df["station"] == station)]
+
+        def show_station(station, df_filtered):
             settings["title"] = f"{self.stations_dict[station]} ({station})"
-            settings = self.get_h_line_value(df_filtered, settings)
+            self.get_h_line_value(df_filtered, settings)
             box_plot(df_filtered, settings)
             show_download_button(
-                df_filtered, {"button_text": lang["download_button_text"]}
+                df_filtered,
+                {
+                    "button_text": lang["download_button_text"],
+                    "key": f"boxplot_{station}",
+                },
             )
 
+        self.show_station_pages(get_station_slices(df), show_station, "boxplot")
+
+    @timed
     def show_stacked_lines(self):
         def get_filter():
             settings = {"stat_par": "", "stations": [], "years": [], "months": []}
@@ -520,11 +628,7 @@ class NCBN:
             )
         st.markdown(lang["intro-stacked-lines"].format(lang["intro_plot"]))
 
-        year_field = (
-            ["year"] if self.time_aggregation in ("day", "week", "month") else []
-        )
-        df = self.get_base_data(get_filter(), add_fields=year_field)
-        df = self.get_aggregated_data(df)
+        df = self.get_aggregated_data(get_filter())
         df.rename(columns={self.parameters[0]: self.par_label_no_unit}, inplace=True)
         
         if self.time_aggregation == 'year':
@@ -556,17 +660,21 @@ class NCBN:
             "tooltip": field_list,
         }
 
-        stations = df["station"].unique()
-        for station in stations:
-            df_filtered = df[
-                (df["station"] == station) & (df[self.par_label_no_unit].notna())
-            ]
+        def show_station(station, df_filtered):
+            df_filtered = df_filtered.dropna(subset=[self.par_label_no_unit])
             settings["title"] = f"{df_filtered.iloc[0]['station name']} ({station})"
             line_chart(df_filtered, settings)
             show_download_button(
-                df_filtered, {"button_text": lang["download_button_text"]}
+                df_filtered,
+                {
+                    "button_text": lang["download_button_text"],
+                    "key": f"stacked_lines_{station}",
+                },
             )
 
+        self.show_station_pages(get_station_slices(df), show_station, "stacked_lines")
+
+    @timed
     def show_heatmap(self):
         def get_filter():
             settings = {"stat_par": "", "stations": [], "years": [], "months": []}
@@ -580,15 +688,17 @@ class NCBN:
 
         st.header(lang["heatmap"].format(self.par_label_no_unit))
         st.markdown(lang["intro_heatmap"].format(lang["intro_plot"]))
-        df = self.filter_base_data(get_filter())
-        agg_func = self.parameters_agg_dict[self.parameters[0]]
         agg_parameters = ["station", "year", self.time_aggregation]
-        df = (
-            df.groupby(agg_parameters)[self.parameters]
-            .agg([agg_func])
-            .reset_index()
-            .round(2)
-        )
+        if self.time_aggregation in ("day", "week", "month"):
+            df = self.get_aggregated_data(get_filter())
+        else:
+            # the yearly values, arranged by decade for decadal values
+            df = self.get_aggregated_data(get_filter(), "year")
+            if self.time_aggregation == "year":
+                agg_parameters = ["station", "year"]
+            else:
+                df["decade"] = (df["year"] // 10) * 10
+        df = df[agg_parameters + self.parameters].round(2)
         df.columns = agg_parameters + [self.par_label_no_unit]
         # df = df[["station", "year", self.time_aggregation, self.par_label_no_unit]]
         settings = {
@@ -602,15 +712,21 @@ class NCBN:
             "tooltip": [self.time_aggregation, "year", self.par_label_no_unit],
             "show_numbers": (self.time_aggregation == "month"),
         }
-        stations = df["station"].unique()
-        for station in stations:
-            df_filtered = df[df["station"] == station]
+
+        def show_station(station, df_filtered):
             settings["title"] = f"{self.stations_dict[station]} ({station})"
             heatmap(df_filtered, settings)
             show_download_button(
-                df_filtered, {"button_text": lang["download_button_text"]}
+                df_filtered,
+                {
+                    "button_text": lang["download_button_text"],
+                    "key": f"heatmap_{station}",
+                },
             )
 
+        self.show_station_pages(get_station_slices(df), show_station, "heatmap")
+
+    @timed
     def show_time_series(self):
         def get_filter():
             settings = {"stat_par": "", "stations": [], "years": [], "months": []}
@@ -625,47 +741,140 @@ class NCBN:
         st.header(lang["time_series"].format(self.par_label_no_unit))
         st.markdown(lang["time_series_intro"].format(lang["intro_plot"]))
         agg_func = self.parameters_agg_dict[self.parameters[0]]
-        df = self.filter_base_data(get_filter())
-        if (self.time_aggregation in ("week", "day")) & (
-            (self.max_year - self.min_year) > 1
-        ):
-            df = df[df["year"] == datetime.now().year]
-            st.info(lang["interval_too_long"])
-        if len(df["station"].unique()) > 10:
-            st.info(lang["too_many_stations"])
+        # long daily series of many stations are reduced to the chart width in
+        # plots.time_series_line, so the whole period can be shown
+        if self.time_aggregation in ("day", "week"):
+            add_fields = ["year", self.time_aggregation]
+            df = self.get_base_data(get_filter(), add_fields, include_date=True)
         else:
-            df = add_date_column(df, self.time_aggregation)
-            aggregation_fields = (
-                ["year", "station", self.time_aggregation, "date"]
-                if self.time_aggregation != "year"
-                else ["station", self.time_aggregation, "date"]
+            # monthly, yearly and decadal values are read from the cubes
+            df = self.get_aggregated_data(get_filter())
+        df = add_date_column(df, self.time_aggregation)
+        aggregation_fields = (
+            ["year", "station", self.time_aggregation, "date"]
+            if self.time_aggregation != "year"
+            else ["station", self.time_aggregation, "date"]
+        )
+        if self.time_aggregation == "week":
+            df = (
+                df.groupby(aggregation_fields, observed=True)[self.parameters]
+                .agg([agg_func])
+                .reset_index()
             )
-            if self.time_aggregation != "daily":
-                df = (
-                    df.groupby(aggregation_fields)[self.parameters]
-                    .agg([agg_func])
-                    .reset_index()
-                )
-                df.columns = aggregation_fields + [self.par_label_no_unit]
-            tooltip = list(df.columns)
-            min_val = math.floor(df[self.par_label_no_unit].min()) - 1
-            max_val = math.ceil(df[self.par_label_no_unit].max()) + 1
-            settings = {
-                "x": "date",
-                "y": self.par_label_no_unit,
-                "color": "station",
-                "width": 800,
-                "height": 400,
-                "y_title": self.par_label_no_unit,
-                "x_title": lang["year"],
-                "y_domain": [min_val, max_val],
-                "title": "",
-                "tooltip": tooltip,
+        else:
+            df = df[aggregation_fields + self.parameters]
+        df.columns = aggregation_fields + [self.par_label_no_unit]
+        tooltip = list(df.columns)
+        min_val = math.floor(df[self.par_label_no_unit].min()) - 1
+        max_val = math.ceil(df[self.par_label_no_unit].max()) + 1
+        settings = {
+            "x": "date",
+            "y": self.par_label_no_unit,
+            "color": "station",
+            "width": 800,
+            "height": 400,
+            "y_title": self.par_label_no_unit,
+            "x_title": lang["year"],
+            "y_domain": [min_val, max_val],
+            "title": "",
+            "tooltip": tooltip,
+        }
+        settings = self.get_h_line_value(df, settings)
+        time_series_line(df, settings)
+        show_download_button(df, {"button_text": lang["download_button_text"]})
+
+    @timed
+    def show_anomaly_heatmap(self):
+        def get_filter():
+            settings = {"stat_par": "", "stations": [], "years": [], "months": []}
+            options = {
+                "stations_dict": self.stations_dict,
+                "min_year": self.min_year,
+                "max_year": self.max_year,
             }
-            settings = self.get_h_line_value(df, settings)
-            time_series_line(df, settings)
-            show_download_button(df, {"button_text": lang["download_button_text"]})
+            filter = show_filter(settings, lang, options)
+            return filter
 
+        st.header(lang["anomaly-heatmap"].format(self.par_label_no_unit))
+        st.markdown(lang["intro-anomalies"])
+        # anomalies are precomputed at ingest, see climatology.write_tables
+        df = read_anomalies(
+            "month", self.reference_period, get_filter(), self.parameters
+        ).round(2)
+        if len(df) == 0:
+            # no station has normals for the parameter and reference period
+            st.markdown(lang["no_data"])
+            return
+        df = df.rename(columns={self.parameters[0]: lang["anomaly"]})
+        settings = {
+            "x": "month:N",
+            "y": "year:N",
+            "color": lang["anomaly"],
+            "color_range": ["steelblue", "white", "darkred"],
+            "color_mid": 0,
+            "width": 800,
+            "height": 400,
+            "tooltip": ["month", "year", lang["anomaly"]],
+            "show_numbers": True,
+        }
+
+        def show_station(station, df_filtered):
+            settings["title"] = f"{self.stations_dict[station]} ({station})"
+            heatmap(df_filtered, settings)
+            show_download_button(
+                df_filtered,
+                {
+                    "button_text": lang["download_button_text"],
+                    "key": f"anomaly_heatmap_{station}",
+                },
+            )
+
+        self.show_station_pages(get_station_slices(df), show_station, "anomaly_heatmap")
+
+    @timed
+    def show_anomaly_time_series(self):
+        def get_filter():
+            settings = {"stat_par": "", "stations": [], "years": [], "months": []}
+            options = {
+                "stations_dict": self.stations_dict,
+                "min_year": self.min_year,
+                "max_year": self.max_year,
+            }
+            filter = show_filter(settings, lang, options)
+            return filter
+
+        st.header(lang["anomaly-time-series"].format(self.par_label_no_unit))
+        st.markdown(lang["intro-anomalies"])
+        # anomalies are stored for monthly and yearly values
+        time_aggregation = (
+            self.time_aggregation if self.time_aggregation == "year" else "month"
+        )
+        df = read_anomalies(
+            time_aggregation, self.reference_period, get_filter(), self.parameters
+        )
+        if len(df) == 0:
+            st.markdown(lang["no_data"])
+            return
+        df = df.rename(columns={self.parameters[0]: lang["anomaly"]})
+        df = add_date_column(df, time_aggregation)
+        min_val = math.floor(df[lang["anomaly"]].min()) - 1
+        max_val = math.ceil(df[lang["anomaly"]].max()) + 1
+        settings = {
+            "x": "date",
+            "y": lang["anomaly"],
+            "color": "station",
+            "width": 800,
+            "height": 400,
+            "y_title": self.parameters_short_dict[self.parameters[0]],
+            "x_title": lang["year"],
+            "y_domain": [min_val, max_val],
+            "title": "",
+            "tooltip": list(df.columns),
+        }
+        time_series_line(df, settings)
+        show_download_button(df, {"button_text": lang["download_button_text"]})
+
+    @timed
     def show_histogram(self):
         def get_filter():
             settings = {"stat_par": "", "stations": [], "years": [], "months": []}
@@ -681,15 +890,8 @@ class NCBN:
             lang["histogram"].format(self.parameters_short_dict[self.parameters[0]])
         )
         st.markdown(lang["intro_histogram"].format(lang["intro_plot"]))
-        df = self.filter_base_data(get_filter())
-        agg_func = self.parameters_agg_dict[self.parameters[0]]
-        aggregation_fields = ["year", "station", self.time_aggregation]
-        df = (
-            df.groupby(aggregation_fields)[self.parameters]
-            .agg([agg_func])
-            .reset_index()
-        )
-        df.columns = aggregation_fields + [self.par_label_no_unit]
+        df = self.get_aggregated_data(get_filter())
+        df = df.rename(columns={self.parameters[0]: self.par_label_no_unit})
         min_val = math.floor(df[self.par_label_no_unit].min()) - 1
         max_val = math.ceil(df[self.par_label_no_unit].max()) + 1
         settings = {
@@ -704,13 +906,21 @@ class NCBN:
             "x_domain": [min_val, max_val],
             "tooltip": ["count()"],
         }
-        stations = df["station"].unique()
-        for station in stations:
-            df_filtered = df[df["station"] == station]
+
+        def show_station(station, df_filtered):
             settings["title"] = f"{self.stations_dict[station]} ({station})"
             histogram(df_filtered, settings)
-            show_download_button(df, {"button_text": lang["download_button_text"]})
+            show_download_button(
+                df_filtered,
+                {
+                    "button_text": lang["download_button_text"],
+                    "key": f"histogram_{station}",
+                },
+            )
 
+        self.show_station_pages(get_station_slices(df), show_station, "histogram")
+
+    @timed
     def show_spiral(self):
         def get_filter():
             settings = {"stat_par": "", "station": [], "years": [], "months": []}
@@ -727,22 +937,22 @@ class NCBN:
             lang["intro-spiral"].format(lang["intro_plot"]), unsafe_allow_html=True
         )
         filter = get_filter()
-        df = self.filter_base_data(filter)
-        agg_func = self.parameters_agg_dict[self.parameters[0]]
-        aggregation_fields = ["year", "station", self.time_aggregation]
-        df = (
-            df.groupby(aggregation_fields)[self.parameters]
-            .agg([agg_func])
-            .reset_index()
+        # one turn of the spiral per year, yearly and decadal values use months
+        time_aggregation = (
+            self.time_aggregation
+            if self.time_aggregation in SPIRAL_PERIODS
+            else "month"
         )
-        df.columns = ["year", "station", self.time_aggregation] + [
-            self.par_label_no_unit
-        ]
+        df = self.get_aggregated_data(filter, time_aggregation)
+        df = df.rename(columns={self.parameters[0]: self.par_label_no_unit})
         min_val = math.floor(df[self.par_label_no_unit].min())
         max_val = math.ceil(df[self.par_label_no_unit].max())
         df_filtered = df[df["station"] == filter["station"]]
+        df_filtered = df_filtered.sort_values(by=["year", time_aggregation])
         settings = {
-            "month": "month",
+            "month": time_aggregation,
+            "period": SPIRAL_PERIODS[time_aggregation],
+            "max_points": SPIRAL_MAX_POINTS,
             "year": "year",
             "value": self.par_label_no_unit,
             "width": 800,
@@ -822,9 +1032,35 @@ class NCBN:
                     self.parameters_label = self.parameters_short_dict[
                         self.parameters[0]
                     ]
+                anomaly_options = lang["stats-analysis-options"][
+                    Plot.ANOMALY_HEATMAP.value :
+                ]
+                if sel_analysis in anomaly_options:
+                    self.reference_period = st.selectbox(
+                        label=lang["reference-period"],
+                        options=list(REFERENCE_PERIODS.keys()),
+                        index=len(REFERENCE_PERIODS) - 1,
+                    )
+            if (
+                self.menu_selection == "data"
+                and analysis_options.index(sel_analysis) == 1
+            ):
+                scope_options = dict(zip(RECORD_SCOPES, lang["record-scope-options"]))
+                self.record_scope = st.selectbox(
+                    label=lang["record-scope"],
+                    options=list(scope_options.keys()),
+                    format_func=lambda x: scope_options[x],
+                )
+                kind_options = dict(zip(RECORD_KINDS, lang["record-kind-options"]))
+                self.record_kind = st.selectbox(
+                    label=lang["record-kind"],
+                    options=list(kind_options.keys()),
+                    format_func=lambda x: kind_options[x],
+                )
 
             return sel_analysis
 
+    @timed
     def show_ressources(self):
         @st.cache_data()
         def get_ressource_data():
@@ -839,19 +1075,18 @@ class NCBN:
         html_table = df.to_html(escape=False, index=False)
         st.markdown(html_table, unsafe_allow_html=True)
 
+    @timed
     def show_about(self, app_name):
         data_source_link = "https://www.meteoswiss.admin.ch/weather/measurement-systems/land-based-stations/swiss-national-basic-climatological-network.html"
-        last_data_refresh = st.session_state["last_data_refresh"]
         station_number = len(self.station_df)
         st.image("saentis_wide.jpg", use_column_width=True)
         st.header(app_name)
-        st.markdown(
-            lang["app-info"].format(station_number, data_source_link, last_data_refresh)
-        )
+        st.markdown(lang["app-info"].format(station_number, data_source_link))
         st.markdown("**Parameters**")
         for key, value in self.parameters_dict.items():
             st.markdown(f"- {value}")
 
+    @timed
     def show_stats(self):
         config = ["time-aggregation", "analysis-options", "parameter"]
         sel_analysis = self.get_parameters(config)
@@ -872,7 +1107,12 @@ class NCBN:
             self.show_spiral()
         elif lang["stats-analysis-options"].index(sel_analysis) == 7:
             self.show_histogram()
+        elif lang["stats-analysis-options"].index(sel_analysis) == 8:
+            self.show_anomaly_heatmap()
+        elif lang["stats-analysis-options"].index(sel_analysis) == 9:
+            self.show_anomaly_time_series()
 
+    @timed
     def show_stations(self):
         def show_map():
             def format_popup_row(row):
@@ -898,7 +1138,7 @@ class NCBN:
                             </table>"""
                 return result
 
-            df = self.station_df
+            df = self.station_df.copy()
 
             df["tooltip"] = df.apply(format_popup_row, axis=1)
             num_of_stations = len(self.station_df)
@@ -923,7 +1163,7 @@ class NCBN:
                 data_download_link = """<a href="{}">{}</a>""".format(
                     row.iloc[0]["url"], lang["download-station-data"]
                 )
-                df = self.station_df.drop(columns=["url", "station-info", "tooltip"])
+                df = df.drop(columns=["url", "station-info", "tooltip"])
                 row = df[df["station"] == station]
                 transposed_df = row.T
                 st.dataframe(transposed_df, use_container_width=True)
@@ -951,6 +1191,7 @@ class NCBN:
         elif lang["stations-analysis-options"].index(sel_menu) == 1:
             show_stats()
 
+    @timed
     def display_data_grid(self):
         def get_filter():
             settings = {
@@ -973,23 +1214,8 @@ class NCBN:
         filter = get_filter()
         if self.time_aggregation == "day":
             df = self.get_base_data(filter, include_date=True)
-        elif self.time_aggregation in ("week", "month"):
-            df = self.get_base_data(filter, add_fields=["year"])
         else:
-            df = self.get_base_data(filter)
-        agg_func = {f: self.parameters_agg_dict[f] for f in self.parameters}
-        if self.time_aggregation in ("month", "week"):
-            df = (
-                df.groupby(["station", "year", self.time_aggregation])[self.parameters]
-                .agg(agg_func)
-                .reset_index()
-            )
-        elif self.time_aggregation in ("year", "decade"):
-            df = (
-                df.groupby(["station", self.time_aggregation])[self.parameters]
-                .agg(agg_func)
-                .reset_index()
-            )
+            df = self.get_aggregated_data(filter)
         df = self.filter_values(filter, df)
         df = self.merge_station_columns(df, ["station name"])
         df = self.rename_columns(df)
@@ -1006,7 +1232,52 @@ class NCBN:
             column_config=config,
         )
 
+    @timed
+    def display_records(self):
+        """Shows the records of the selected parameters set in a year, read
+        from the extremes index, see records.py."""
+
+        def get_filter():
+            settings = {"stations": [], "year": None}
+            options = {
+                "stations_dict": self.stations_dict,
+                "min_year": self.min_year,
+                "max_year": self.max_year,
+            }
+            filter = show_filter(settings, lang, options)
+            return filter
+
+        def format_period(key):
+            if self.record_scope == "day":
+                return f"{key % 100:02d}.{key // 100:02d}."
+            return str(key)
+
+        st.header(lang["records"])
+        st.markdown(lang["records-intro"])
+        filter = get_filter()
+        df = get_records_set(
+            filter["year"],
+            self.parameters,
+            self.record_scope,
+            self.record_kind,
+            filter["stations"],
+        )
+        df["parameter"] = df["parameter"].map(
+            lambda x: remove_unit(self.parameters_short_dict[x])
+        )
+        df["key"] = df["key"].map(format_period)
+        if self.record_scope == "year":
+            df = df.drop(columns="key")
+        df = self.merge_station_columns(df, ["station name"])
+        df = self.rename_columns(df)
+        df = df.rename(columns=dict(zip(RECORD_COLUMNS, lang["record-columns"])))
+        st.markdown(lang["records-found"].format(len(df), filter["year"]))
+        st.dataframe(df, hide_index=True, use_container_width=True)
+        show_download_button(df, {"button_text": lang["download_button_text"]})
+
     def get_lin_reg(self, df: pd.DataFrame):
+        from scipy import stats
+
         df = df.dropna(how="all")
         if len(df) > 2:
             df["X_numeric"] = (df["date"] - df["date"].min()).dt.days
@@ -1017,11 +1288,11 @@ class NCBN:
         else:
             return None, None, None, None, None
 
+    @timed
     def mann_kendall(self):
-        """
-        https://github.com/mmhs013/pymannkendall
-        Hussain et al., (2019). pyMannKendall: a python package for non parametric Mann Kendall family of trend tests.. Journal of Open Source Software, 4(39), 1556, https://doi.org/10.21105/joss.01556
-        """
+        """Seasonal Mann-Kendall test and Sen's slope of the selected stations,
+        computed for all stations at once by trend.seasonal_mann_kendall. The
+        results are cached by parameter, filter and data version."""
 
         def get_filter():
             settings = {"stat_par": "", "stations": [], "years": [], "months": []}
@@ -1048,24 +1319,9 @@ class NCBN:
             df = pd.DataFrame({"Parameter": keys, "Value": values})
             return df
 
-        def show_result(result):
-            ok = self.display == lang["trend-display-options"][0]
-            ok = ok or (
-                self.display == lang["trend-display-options"][1]
-                and result.trend == self.display
-            )
-            return ok
-
-        df = self.filter_base_data(get_filter())
-        df = df.dropna(subset=[self.parameters[0]])
-        agg_func = self.parameters_agg_dict[self.parameters[0]]
-        aggregation_fields = ["year", "month", "station"]
-        df = (
-            df.groupby(aggregation_fields)[self.parameters]
-            .agg([agg_func])
-            .reset_index()
-        )
-        df.columns = aggregation_fields + [self.par_label_no_unit]
+        filter = get_filter()
+        df = self.get_aggregated_data(filter, time_aggregation="month")
+        df = df.rename(columns={self.parameters[0]: self.par_label_no_unit})
         df = add_date_column(df, "month")
         settings = {
             "x": "date",
@@ -1085,53 +1341,66 @@ class NCBN:
         min_y = int(df[self.par_label_no_unit].min()) - 1
         max_y = int(df[self.par_label_no_unit].max()) + 1
         settings["y_domain"] = [min_y, max_y]
-        cnt_stations = 0
-        cnt_all_stations = 0
 
-        for station in self.stations_dict.keys():
+        # all stations are tested at once, only the charts of the stations
+        # matching the selected trend are rendered
+        key = cache.get_key(
+            self.parameters[0], filter, MIN_POINTS, store.get_data_version()
+        )
+        results = cache.read_result("trend", key)
+        if results is None:
+            results = seasonal_mann_kendall(
+                df, [self.par_label_no_unit], min_points=MIN_POINTS
+            )
+            cache.write_result("trend", key, results)
+        display_index = lang["trend-display-options"].index(self.display)
+        if display_index > 0:
+            trend = TREND_KEYS[display_index - 1]
+            results = results[results["trend"] == trend]
+        results = results.set_index("station")
+        station_slices = get_station_slices(df)
+        station_slices = {
+            station: station_slices[station]
+            for station in self.stations_dict.keys()
+            if station in results.index
+        }
+
+        def show_station(station, filtered_df):
+            result = results.loc[station]
             cols = st.columns([3, 1])
-            filtered_df = df[df["station"] == station].sort_values(by="date")
-
-            if len(filtered_df) > MIN_POINTS:
-                # settings['x_domain'] = [ f"{df['month_date'].min().year}-01-01", f"{df['month_date'].max().year}-12-31"]
-                cnt_all_stations += 1
-                values = list(filtered_df[self.par_label_no_unit])
-                result = mk.seasonal_test(values, 12)
-                if show_result(result):
-                    settings[
-                        "title"
-                    ] = f"{self.stations_dict[station]} ({station}): {result.trend}"
-                    with cols[0]:
-                        if settings["show_regression"]:
-                            (
-                                slope,
-                                intercept,
-                                r_value,
-                                p_value,
-                                std_err,
-                            ) = self.get_lin_reg(filtered_df)
-
-                        time_series_chart(filtered_df, settings)
-                    with cols[1]:
-                        summary_df = get_summary_df(df, result)
-                        st.dataframe(
-                            summary_df, hide_index=True, use_container_width=True
-                        )
-                    cnt_stations += 1
-                    num_stations.markdown(
-                        lang["stations-shown"].format(
-                            cnt_stations, len(self.stations_dict)
-                        )
-                    )
+            filtered_df = filtered_df.sort_values(by="date")
+            settings["title"] = (
+                f"{self.stations_dict[station]} ({station}): {result.trend}"
+            )
+            with cols[0]:
+                if settings["show_regression"]:
+                    (
+                        slope,
+                        intercept,
+                        r_value,
+                        p_value,
+                        std_err,
+                    ) = self.get_lin_reg(filtered_df)
+
+                time_series_chart(filtered_df, settings)
+            with cols[1]:
+                summary_df = get_summary_df(filtered_df, result)
+                st.dataframe(summary_df, hide_index=True, use_container_width=True)
+
+        num_stations.markdown(
+            lang["stations-shown"].format(len(station_slices), len(self.stations_dict))
+        )
+        self.show_station_pages(station_slices, show_station, "mann_kendall")
 
+    @timed
     def show_browse_data(self, config):
-        # todo: include records menu item: show value and date for record events
-        # record year, month, date
         sel_analysis = self.get_parameters(config)
-        self.display_data_grid()
-        # if analysis_options.index(sel_analysis) == 0:
-        #     self.display_data_grid()
+        if lang["browse-data-options"].index(sel_analysis) == 0:
+            self.display_data_grid()
+        else:
+            self.display_records()
 
+    @timed
     def show_trend(self):
         def get_filter():
             settings = {
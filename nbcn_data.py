@@ -2,13 +2,64 @@
 import streamlit as st
 import pandas as pd
 import os
+import json
+import time
+import shutil
 import datetime
-import numpy as np
+import requests
+import pyarrow as pa
+import pyarrow.compute as pc
+from pyarrow import csv
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # from st_files_connection import FilesConnection
-from helper import reduce_memory_usage
+import store
+import aggregates
+import climatology
+import records
+import cache
+import snapshots
+from timing import timed
+from helper import reduce_memory_usage, compact_dtypes, decode_dtypes
 
 STATIONS_METADATA_URL = "./data/1_download_url_nbcn_homogen.csv"
+MAX_WORKERS = 8
+REQUEST_TIMEOUT = 60
+
+PARAMETERS = [
+    "gre000d0",
+    "hto000d0",
+    "nto000d0",
+    "prestad0",
+    "rre150d0",
+    "sre000d0",
+    "tre200d0",
+    "tre200dn",
+    "tre200dx",
+    "ure200d0",
+]
+# column types of the MeteoSwiss NBCN daily data files
+NBCN_SCHEMA = {"station/location": pa.string(), "date": pa.timestamp("ns")}
+NBCN_SCHEMA.update({par: pa.float64() for par in PARAMETERS})
+
+# aggregation function used for each parameter when aggregating daily values
+PARAMETERS_AGG_DICT = {
+    "gre000d0": "mean",
+    "hto000d0": "mean",
+    "nto000d0": "mean",
+    "prestad0": "mean",
+    "rre150d0": "sum",
+    "sre000d0": "sum",
+    "tre200d0": "mean",
+    "tre200dn": "min",
+    "tre200dx": "max",
+    "ure200d0": "mean",
+}
+# storage type of each column in the partitioned dataset: parameters are
+# published with one decimal and stored as values * 10 in Int16 columns
+STORAGE_SPECS = {par: {"dtype": "int16", "decimals": 1} for par in PARAMETERS}
+STORAGE_SPECS["station"] = {"dtype": "category"}
 
 DATA_DICT = {
     "stations_file": "https://data.geo.admin.ch/ch.meteoschweiz.klima/nbcn-tageswerte/liste-download-nbcn-d.csv",
@@ -47,45 +98,317 @@ def get_stations_df():
     return df
 
 
+def read_station_file(source):
+    """
+    Parses a MeteoSwiss NBCN daily data file using the pyarrow csv reader. The
+    column types, the missing value marker "-" and the date format are declared
+    up front, the calendar columns are derived in one vectorized pass.
+
+    :param source: path or file-like object of a station csv file
+    :return: DataFrame with the columns station, date, the parameters and the
+             calendar columns day, month, week, year and decade
+    """
+    table = csv.read_csv(
+        source,
+        parse_options=csv.ParseOptions(delimiter=";"),
+        convert_options=csv.ConvertOptions(
+            column_types=NBCN_SCHEMA,
+            null_values=["-"],
+            strings_can_be_null=True,
+            timestamp_parsers=["%Y%m%d"],
+        ),
+    )
+    table = table.rename_columns(
+        ["station" if x == "station/location" else x for x in table.column_names]
+    )
+    dates = table["date"]
+    year = pc.cast(pc.year(dates), pa.int32())
+    table = (
+        table.append_column("day", pc.cast(pc.day_of_year(dates), pa.int32()))
+        .append_column("month", pc.cast(pc.month(dates), pa.int32()))
+        .append_column("week", pc.cast(pc.iso_week(dates), pa.uint32()))
+        .append_column("year", year)
+        .append_column(
+            "decade", pc.cast(pc.multiply(pc.divide(year, 10), 10), pa.int32())
+        )
+    )
+    return table.to_pandas()
+
+
+def get_conditional_headers(entry: dict):
+    """
+    Builds the HTTP conditional request headers from a manifest entry, so an
+    unchanged station file is answered with 304 Not Modified.
+    """
+    headers = {}
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+def fetch_station_file(station: str, url: str, headers: dict = None):
+    """
+    Downloads and parses the data file of a single station.
+
+    :param station: station abbreviation, used for the fetch log
+    :param url: url of the station csv file
+    :param headers: optional request headers, e.g. conditional request headers
+    :return: tuple (cleaned DataFrame or None on failure or if the file was not
+             modified, fetch log record)
+    """
+    record = {"station": station, "url": url, "rows": 0, "bytes": 0, "seconds": 0.0}
+    record.update({"not_modified": False, "etag": None, "last_modified": None})
+    record["error"] = None
+    headers = {} if headers is None else headers
+    start = time.perf_counter()
+    df = None
+    try:
+        response = requests.get(url, headers=headers, timeout=REQUEST_TIMEOUT)
+        response.raise_for_status()
+        record["etag"] = response.headers.get("ETag")
+        record["last_modified"] = response.headers.get("Last-Modified")
+        record["bytes"] = len(response.content)
+        if response.status_code == 304:
+            record["not_modified"] = True
+        else:
+            df = read_station_file(BytesIO(response.content))
+            record["rows"] = len(df)
+    except Exception as e:
+        record["error"] = str(e)
+    record["seconds"] = round(time.perf_counter() - start, 3)
+    return df, record
+
+
+def fetch_stations(
+    url_df: pd.DataFrame,
+    url_column: str,
+    manifest: dict = None,
+    max_workers: int = MAX_WORKERS,
+):
+    """
+    Downloads the station files listed in url_df concurrently using a bounded
+    thread pool. Files are parsed as soon as they arrive and concatenated once
+    at the end, a failing station is logged and skipped.
+
+    :param url_df: stations list with the columns station and url_column
+    :param url_column: column holding the file url for the requested mode
+    :param manifest: if given, stations are requested conditionally using the
+                     etag and last-modified values of their manifest entry
+    :param max_workers: maximum number of concurrent downloads
+    :return: tuple (combined DataFrame, fetch log DataFrame with one row per station)
+    """
+    manifest = {} if manifest is None else manifest
+    frames = []
+    log = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                fetch_station_file,
+                station,
+                url,
+                get_conditional_headers(manifest.get(station, {})),
+            )
+            for station, url in zip(url_df["station"], url_df[url_column])
+        ]
+        for future in as_completed(futures):
+            df, record = future.result()
+            log.append(record)
+            if df is not None:
+                frames.append(df)
+    log_df = pd.DataFrame(log).sort_values(by="seconds", ascending=False)
+    if frames == []:
+        return pd.DataFrame(), log_df
+    df_all = pd.concat(frames, ignore_index=True)
+    df_all.columns = [x.lower() for x in df_all.columns]
+    df_all = df_all.sort_values(by=["station", "date"], ignore_index=True)
+    return df_all, log_df
+
+
+def print_fetch_log(mode: str, log_df: pd.DataFrame):
+    failed_df = log_df[log_df["error"].notna()]
+    print(
+        "{}: {} stations fetched, {} not modified, {:.1f} Kb, {} failed".format(
+            mode,
+            len(log_df) - len(failed_df) - log_df["not_modified"].sum(),
+            log_df["not_modified"].sum(),
+            log_df["bytes"].sum() / 1024,
+            len(failed_df),
+        )
+    )
+    for _, row in log_df.head(3).iterrows():
+        print(f"  slowest: {row['station']} {row['seconds']:.2f}s")
+    for _, row in failed_df.iterrows():
+        print(f"  failed: {row['station']} {row['error']}")
+
+
+def get_manifest_file(mode: str):
+    return snapshots.FETCH_MANIFEST_FILES[mode]
+
+
+def read_manifest(mode: str):
+    """
+    Returns the manifest of a parquet file: a dict holding for each station the
+    last ingested date and the etag and last-modified values of its source
+    file. An empty dict is returned if no manifest exists.
+    """
+    manifest_file = get_manifest_file(mode)
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, "r") as file:
+        return json.load(file)
+
+
+def write_manifest(mode: str, manifest: dict):
+    manifest_file = get_manifest_file(mode)
+    temp_file = f"{manifest_file}.{os.getpid()}.tmp"
+    with open(temp_file, "w") as file:
+        json.dump(manifest, file, indent=4)
+    snapshots.write_file_atomic(temp_file, manifest_file)
+
+
+def update_manifest(manifest: dict, df: pd.DataFrame, log_df: pd.DataFrame):
+    """
+    Adds the validators of the fetched files and the last date ingested for
+    each station in df to the manifest.
+    """
+    for record in log_df.to_dict("records"):
+        if record["error"] is None and not record["not_modified"]:
+            entry = manifest.setdefault(record["station"], {})
+            entry["etag"] = record["etag"]
+            entry["last_modified"] = record["last_modified"]
+    if len(df) > 0:
+        last_dates = df.groupby("station")["date"].max()
+        for station, last_date in last_dates.items():
+            manifest.setdefault(station, {})["last_date"] = last_date.strftime(
+                "%Y-%m-%d"
+            )
+    return manifest
+
+
 def load_data(load_all_data: bool):
-    def clean_data(df: pd.DataFrame):
-        df.rename(columns={"station/location": "Station", "date": "Date"}, inplace=True)
-        df["Date"] = df["Date"].astype(str)
-        # Convert the column to datetime format
-        df["Date"] = pd.to_datetime(df["Date"], format="%Y%m%d")
-        # remove text columns then convert each column to float after
-        # replacing the missing values - by None
-        cols = df.columns.drop(["Station", "Date"])
-        for col in cols:
-            df[col] = df[col].replace("-", np.nan)
-            df[col] = df[col].astype(float)
-        # adds a Month and date column
-        df["day"] = df["Date"].dt.dayofyear
-        df["month"] = df["Date"].dt.month
-        df["week"] = df["Date"].dt.isocalendar().week
-        df["year"] = df["Date"].dt.year
-        df["decade"] = (df["year"] // 10) * 10
-        return df
+    """
+    Downloads the station files and writes them to the parquet files of the
+    data folder. Stations whose file fails to download keep their rows of the
+    existing snapshot, without a snapshot the load fails.
+
+    :param load_all_data: if True, the verified data of the previous years is
+                          reloaded as well
+    :return: dict with the fetch log DataFrame for each loaded mode
+    """
 
     def write_to_parquet(mode: str):
-        df_all = None
-        list_files = list(url_df[DATA_DICT[mode]["url"]])
-        for url in list_files:
-            df = pd.read_csv(url, sep=";")
-            df = clean_data(df)
-            if df_all is None:
-                df_all = df
-            else:
-                df_all = pd.concat([df_all, df], ignore_index=True)
-        df_all.columns = [x.lower() for x in df_all.columns]
-        df_all.to_parquet(DATA_DICT[mode]["target_file"], index=False, engine="pyarrow")
+        df_all, log_df = fetch_stations(url_df, DATA_DICT[mode]["url"])
+        print_fetch_log(mode, log_df)
+        if len(df_all) == 0:
+            raise RuntimeError(f"no station data could be fetched for {mode}")
+        failed = list(log_df.loc[log_df["error"].notna(), "station"])
+        if failed:
+            if not snapshots.snapshot_exists(mode):
+                raise RuntimeError(f"{mode}: failed to fetch {', '.join(failed)}")
+            # the failed stations keep their rows of the pinned version, a
+            # transient error must not remove their history from the snapshot
+            kept_df = snapshots.read_snapshot(
+                mode, versions[mode], filters=[("station", "in", failed)]
+            )
+            df_all = pd.concat([df_all, kept_df], ignore_index=True)
+            df_all = df_all.sort_values(by=["station", "date"], ignore_index=True)
+        snapshots.write_snapshot(mode, df_all)
+        write_manifest(mode, update_manifest({}, df_all, log_df))
+        return log_df
 
     url_df = get_stations_df()
     url_df.dropna(subset=["station"], inplace=True)
+    versions = snapshots.pin()
 
+    logs = {}
     if load_all_data:
-        write_to_parquet("previous")
-    write_to_parquet("current")
+        logs["previous"] = write_to_parquet("previous")
+    logs["current"] = write_to_parquet("current")
+    if load_all_data or not store.dataset_exists():
+        write_dataset()
+    else:
+        decades = snapshots.read_snapshot("current", columns=["decade"])
+        write_dataset(list(decades["decade"].unique()))
+    return logs
+
+
+def refresh_current_data():
+    """
+    Incremental refresh of the current year data: station files are requested
+    conditionally and only rows newer than the last date ingested for a station
+    are appended to the current parquet file. Falls back to a full load of the
+    current data if the parquet file or its manifest does not exist.
+
+    :return: dict with the fetch log DataFrame
+    """
+    manifest = read_manifest("current")
+    if not snapshots.snapshot_exists("current") or manifest == {}:
+        return load_data(load_all_data=False)
+
+    url_df = get_stations_df()
+    url_df.dropna(subset=["station"], inplace=True)
+    df_new, log_df = fetch_stations(url_df, DATA_DICT["current"]["url"], manifest)
+    print_fetch_log("current (delta)", log_df)
+    if len(df_new) > 0:
+        last_dates = {x: entry.get("last_date") for x, entry in manifest.items()}
+        last_dates = pd.to_datetime(df_new["station"].map(last_dates))
+        df_new = df_new[last_dates.isna() | (df_new["date"] > last_dates)]
+    if len(df_new) > 0:
+        df = pd.concat([snapshots.read_snapshot("current"), df_new], ignore_index=True)
+        df = df.drop_duplicates(subset=["station", "date"], keep="last")
+        df = df.sort_values(by=["station", "date"], ignore_index=True)
+        snapshots.write_snapshot("current", df)
+        write_dataset(list(df_new["decade"].unique()))
+    print(f"current (delta): {len(df_new)} new rows appended")
+    write_manifest("current", update_manifest(manifest, df_new, log_df))
+    return {"current": log_df}
+
+
+def write_dataset(decades: list = None):
+    """
+    Writes the previous and current parquet files to the partitioned dataset,
+    the aggregate cubes, the climatology tables and the records index used by
+    the app.
+
+    :param decades: if given, only the partitions of these decades are rewritten,
+                    otherwise the dataset is rebuilt from scratch
+    """
+    if not (
+        aggregates.cubes_exist()
+        and climatology.tables_exist()
+        and records.index_exists()
+    ):
+        # the derived tables of a dataset written before they were kept with it
+        decades = None
+    filters = None if decades is None else [("decade", "in", decades)]
+    # both snapshots are read in the version of the same moment
+    versions = snapshots.pin()
+    df = pd.concat(
+        [
+            snapshots.read_snapshot("previous", versions["previous"], filters=filters),
+            snapshots.read_snapshot("current", versions["current"], filters=filters),
+        ],
+        ignore_index=True,
+    )
+    # the daily data and the derived tables are published by one swap
+    staging_dir = store.create_staging_dir(replace_all=decades is None)
+    try:
+        aggregates.write_cubes(df, PARAMETERS_AGG_DICT, staging_dir, decades)
+        climatology.write_tables(
+            df, list(PARAMETERS_AGG_DICT), staging_dir, decades is None
+        )
+        # the rows of the rewritten decades are merged into the existing index
+        records.write_index(df, PARAMETERS, staging_dir, replace_all=decades is None)
+        df, _ = compact_dtypes(df, STORAGE_SPECS, verbose=True)
+        store.write_dataset(df, staging_dir)
+    except Exception:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+    store.swap_dataset(staging_dir)
+    # cached results are keyed by store.get_data_version and are outdated now
+    cache.clear()
 
 
 def aggregate_data(df: pd.DataFrame):
@@ -93,33 +416,155 @@ def aggregate_data(df: pd.DataFrame):
     df = df.groupby(["station"])[value_fields].agg(["min", "max"]).reset_index()
 
 
-@st.cache_data(show_spinner=False, ttl=3600 * 24)
-def get_data():
+def refresh_data():
     """
-    Combines previous and current data into a single DataFrame.
-
-    :return: Combined DataFrame of previous and current data
+    Makes sure the data exists and is recent: the verified data is reloaded
+    once it includes the last year, the current data is refreshed incrementally.
+    Run by the background refresh, see refresh.py.
     """
-    # make sure the data exists and is recent
-    if not os.path.exists(DATA_DICT["current"]["target_file"]):
+    if not snapshots.snapshot_exists("current"):
         load_data(load_all_data=True)
     else:
         today = datetime.date.today()
         # Get February 1st of the current year
         feb_first = datetime.date(today.year, 2, 1)
-        previous_df = pd.read_parquet(DATA_DICT["previous"]["target_file"])
-        previous_df = reduce_memory_usage(previous_df, True)
+        previous_df = snapshots.read_snapshot("previous", columns=["year"])
         last_year = previous_df["year"].max()
         if today > feb_first and last_year < (today.year - 1):
             load_data(load_all_data=True)
+        elif not data_exists():
+            write_dataset()
+    refresh_current_data()
 
-    previous_df = pd.read_parquet(DATA_DICT["previous"]["target_file"])
 
-    load_data(load_all_data=False)
-    current_df = pd.read_parquet(DATA_DICT["current"]["target_file"])
-    df = pd.concat([previous_df, current_df], ignore_index=True)
-    df = reduce_memory_usage(df, False)
-    return df
+def data_exists():
+    """Returns True if the snapshots, the dataset and the tables derived from
+    it exist."""
+    return (
+        snapshots.snapshot_exists("current")
+        and snapshots.snapshot_exists("previous")
+        and store.dataset_exists()
+        and aggregates.cubes_exist()
+        and climatology.tables_exist()
+        and records.index_exists()
+    )
+
+
+@st.cache_data(show_spinner=False, ttl=3600 * 24)
+def update_data():
+    """
+    Makes sure the data exists before it is read. The data is only loaded
+    during a page load on the first start, it is then kept recent by the
+    background refresh, see refresh.py.
+    """
+    if not data_exists():
+        # refresh imports this module
+        import refresh
+
+        while not refresh.refresh() and not data_exists():
+            # another process is loading the data
+            time.sleep(refresh.CHECK_SECONDS / 10)
+        if not data_exists():
+            raise RuntimeError(f"data could not be loaded: {refresh.read_status()}")
+
+
+class SharedData:
+    """
+    Read-only data and indexes shared by all sessions of the server process.
+    Sessions must not modify the attributes, copy a frame before changing it.
+    """
+
+    def __init__(self):
+        update_data()
+        self.station_df = get_stations_metadata()
+        self.stations_dict = dict(
+            zip(self.station_df["station"], self.station_df["station name"])
+        )
+        self.min_year, self.max_year = store.get_year_range()
+
+
+@timed
+@st.cache_resource(show_spinner=False, ttl=3600 * 24, max_entries=2)
+def get_shared_data(version: str):
+    """
+    Returns the SharedData instance of the process, it is built once per data
+    version and then handed to every session without copying. A refresh by
+    any process changes the version, see store.get_data_version.
+    """
+    return SharedData()
+
+
+@timed
+def get_filtered_data(
+    filters: dict, columns: list = store.COLUMNS, not_null: list = []
+):
+    """
+    Reads the daily data matching the filter dict built by show_filter. The
+    filters are pushed down to the store, so only matching partitions and row
+    groups are read.
+
+    :param filters: filter dict, see store.get_filter_expression
+    :param columns: columns to be read
+    :param not_null: columns whose missing values are filtered out
+    :return: filtered DataFrame
+    """
+    update_data()
+    return read_filtered_data(filters, columns, not_null)
+
+
+@timed
+def read_filtered_data(
+    filters: dict, columns: list = store.COLUMNS, not_null: list = []
+):
+    """
+    Same as get_filtered_data without checking if the data is recent, used
+    outside streamlit, e.g. by the report generator.
+    """
+    df = store.read_data(filters, columns, not_null)
+    df = decode_dtypes(df, STORAGE_SPECS)
+    return reduce_memory_usage(df, False)
+
+
+@timed
+def get_aggregated_data(
+    filters: dict,
+    parameters: list,
+    time_aggregation: str,
+    min_year: int,
+    max_year: int,
+    update: bool = True,
+    version: str = None,
+):
+    """
+    Returns the parameters aggregated by station and time aggregation. Weekly,
+    monthly, yearly and decadal values are read from the aggregate cubes built
+    at ingest time, daily values and filters the cubes cannot answer are
+    aggregated from the daily data.
+
+    :param filters: filter dict as returned by show_filter
+    :param parameters: parameters to be aggregated
+    :param time_aggregation: day, week, month, year or decade
+    :param min_year: first year of the data
+    :param max_year: last year of the data
+    :param update: if False, the daily data is read without checking if it is recent
+    :param version: data version of the cubes, see store.get_data_version
+    :return: DataFrame with station, [year], time aggregation and parameter columns
+    """
+    if aggregates.cube_supports(time_aggregation, filters, min_year, max_year):
+        return aggregates.read_cube(time_aggregation, filters, parameters, version)
+
+    # for day-month, the year must be added ot the aggregation parameters
+    if time_aggregation in ("week", "month", "day"):
+        group_parameters = ["station", "year", time_aggregation]
+    else:
+        group_parameters = ["station", time_aggregation]
+    read_data = get_filtered_data if update else read_filtered_data
+    # with a single parameter, the days without a value are skipped on read
+    not_null = parameters if len(parameters) == 1 else []
+    df = read_data(filters, group_parameters + parameters, not_null)
+    agg_func = {par: PARAMETERS_AGG_DICT[par] for par in parameters}
+    # same aggregation as the cubes, groups without any value are NaN
+    return aggregates.aggregate(df, group_parameters, agg_func)
 
 
 if __name__ == "__main__":
@@ -127,4 +572,8 @@ if __name__ == "__main__":
     Used when module id called outside streamlit. py nbcn_data.py called from the rpl
     automatically loads the data and stores a parquet file in the data folder.
     """
-    load_data(load_all_data=True)
+    import refresh
+
+    # waits for a running refresh, both write the snapshots and the dataset
+    with store.file_lock(refresh.LOCK_FILE, refresh.LOCK_TIMEOUT_HOURS * 3600):
+        load_data(load_all_data=True)
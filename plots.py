@@ -1,16 +1,19 @@
-import plotly.graph_objects as go
-import plotly.express as px
 import streamlit as st
 import pandas as pd
 import numpy as np
 import altair as alt
-import folium
-from streamlit_folium import st_folium
 
 from helper import round_to_nearest
+from timing import timed
 
 
+@timed
 def map_chart(df, settings):
+    # folium and plotly are imported by the charts using them, to keep the
+    # startup of the app short
+    import folium
+    from streamlit_folium import st_folium
+
     initial_latitude = df[settings["latitude"]].iloc[0]
     initial_longitude = df[settings["longitude"]].iloc[0]
     map_object = folium.Map(
@@ -30,6 +33,7 @@ def map_chart(df, settings):
     return st_data
 
 
+@timed
 def line_chart(df, settings):
     title = settings["title"] if "title" in settings else ""
     if "x_dt" not in settings:
@@ -111,6 +115,7 @@ def line_chart(df, settings):
     st.altair_chart(plot)
 
 
+@timed
 def scatter_plot(df, settings):
     title = settings["title"] if "title" in settings else ""
     chart = (
@@ -134,6 +139,7 @@ def scatter_plot(df, settings):
     st.altair_chart(plot)
 
 
+@timed
 def time_series_bar(df, settings):
     chart = (
         alt.Chart(df)
@@ -156,7 +162,49 @@ def time_series_bar(df, settings):
     st.altair_chart(plot)
 
 
+@timed
+def downsample_min_max(df, x, y, max_points, group=None):
+    """
+    Reduces each series to about max_points rows before the chart is built:
+    the series is split into max_points / 2 buckets along x and the rows
+    holding the minimum and maximum y value of each bucket are kept, so peaks
+    remain visible. Series with max_points rows or less are not changed.
+    """
+    keys = [group] if group else []
+    df = df.dropna(subset=[y]).sort_values(by=keys + [x], ignore_index=True)
+    if group:
+        grouped = df.groupby(group, observed=True)
+        position = grouped.cumcount().to_numpy()
+        size = grouped[x].transform("size").to_numpy()
+    else:
+        position = np.arange(len(df))
+        size = np.full(len(df), len(df))
+    if len(df) == 0 or size.max() <= max_points:
+        return df
+
+    buckets = max(max_points // 2, 1)
+    bucket = position * buckets // size
+    grouped = df[y].groupby([df[group], bucket] if group else bucket, observed=True)
+    keep = np.zeros(len(df), dtype=bool)
+    keep[grouped.idxmin().to_numpy()] = True
+    keep[grouped.idxmax().to_numpy()] = True
+    # short series are kept as they are
+    keep |= size <= max_points
+    return df[keep].reset_index(drop=True)
+
+
+@timed
 def time_series_line(df, settings):
+    st.altair_chart(get_time_series_line(df, settings))
+
+
+@timed
+def get_time_series_line(df, settings):
+    # about two points per pixel and series, see downsample_min_max
+    max_points = settings.get("max_points", 2 * settings["width"])
+    df = downsample_min_max(
+        df, settings["x"], settings["y"], max_points, settings.get("color")
+    )
     if "x_domain" in settings:
         xax = alt.X(
             f"{settings['x']}:T",
@@ -226,13 +274,18 @@ def time_series_line(df, settings):
                 )
                 .encode(x=xax, y=yax, tooltip=settings["tooltip"])
             )
-    plot = chart.properties(
+    return chart.properties(
         width=settings["width"], height=settings["height"], title=settings["title"]
     )
-    st.altair_chart(plot)
 
 
+@timed
 def time_series_chart(df, settings):
+    st.altair_chart(get_time_series_chart(df, settings))
+
+
+@timed
+def get_time_series_chart(df, settings):
     # line = alt.Chart(df_line).mark_line(color= 'red').encode(
     #    x= 'x',
     #    y= 'y'
@@ -245,6 +298,15 @@ def time_series_chart(df, settings):
         settings["symbol_size"] = 0
     if "rolling_avg_window" not in settings:
         settings["rolling_avg_window"] = 0
+    # average, regression and moving average are computed on all values before
+    # the series is reduced to about two points per pixel
+    full_df = df
+    if settings["rolling_avg_window"] > 0:
+        df = df.assign(
+            ma=df[settings["y"]].rolling(window=settings["rolling_avg_window"]).mean()
+        )
+    max_points = settings.get("max_points", 2 * settings["width"])
+    df = downsample_min_max(df, settings["x"], settings["y"], max_points)
     plot = (
         alt.Chart(df)
         .mark_line(point=alt.OverlayMarkDef(color="blue", size=settings["symbol_size"]))
@@ -262,16 +324,24 @@ def time_series_chart(df, settings):
     )
     if "show_regression" in settings:
         if len(df) > 2 and settings["show_regression"]:
-            line = plot.transform_regression(settings["x"], settings["y"]).mark_line(
-                color="orange"
+            df_reg = full_df.dropna(subset=[settings["y"]])
+            x = df_reg[settings["x"]].astype("int64").to_numpy(dtype=float)
+            slope, intercept = np.polyfit(x, df_reg[settings["y"]], 1)
+            x_range = np.array([x.min(), x.max()])
+            df_reg = pd.DataFrame(
+                {
+                    "x": pd.to_datetime(x_range.astype("int64")),
+                    "y": intercept + slope * x_range,
+                }
             )
+            line = alt.Chart(df_reg).mark_line(color="orange").encode(x="x:T", y="y:Q")
             plot += line
     if "show_average" in settings:
         if settings["show_average"]:
-            avg = df[settings["y"]].mean()
+            avg = full_df[settings["y"]].mean()
             df_avg = pd.DataFrame(
                 {
-                    "x": [df[settings["x"]].min(), df[settings["x"]].max()],
+                    "x": [full_df[settings["x"]].min(), full_df[settings["x"]].max()],
                     "y": [avg, avg],
                 }
             )
@@ -285,9 +355,6 @@ def time_series_chart(df, settings):
             )
             plot += line
     if settings["rolling_avg_window"] > 0:
-        df["ma"] = (
-            df[settings["y"]].rolling(window=settings["rolling_avg_window"]).mean()
-        )
         # Create the chart
         line = (
             alt.Chart(df)
@@ -296,18 +363,29 @@ def time_series_chart(df, settings):
         )
         plot += line
 
-    plot = plot.properties(
+    return plot.properties(
         width=settings["width"], height=settings["height"], title=title
     )
-    st.altair_chart(plot)
 
 
+@timed
 def heatmap(df, settings):
+    st.altair_chart(get_heatmap(df, settings))
+
+
+@timed
+def get_heatmap(df, settings):
     title = settings["title"] if "title" in settings else ""
     if not ("show_numbers" in settings):
         settings["show_numbers"] = True
     if not ("color_scheme" in settings):
         settings["color_scheme"] = "viridis"
+    # diverging values such as anomalies are centered on color_mid
+    scale = alt.Scale(range=settings.get("color_range", ["lightblue", "darkred"]))
+    if "color_mid" in settings:
+        scale = alt.Scale(
+            range=settings["color_range"], domainMid=settings["color_mid"]
+        )
 
     plot = (
         alt.Chart(df)
@@ -321,7 +399,7 @@ def heatmap(df, settings):
             ),
             color=alt.Color(
                 f"{settings['color']}:Q",
-                scale=alt.Scale(range=["lightblue", "darkred"]),
+                scale=scale,
             ),
             tooltip=settings["tooltip"],
         )
@@ -332,10 +410,10 @@ def heatmap(df, settings):
             text=settings["color"], color=alt.value("black")
         )
 
-    plot = plot.properties(width=settings["width"], title=title)
-    st.altair_chart(plot)
+    return plot.properties(width=settings["width"], title=title)
 
 
+@timed
 def bar_chart(df: pd.DataFrame, settings: dict):
     if "title" not in settings:
         settings["title"] = ""
@@ -377,6 +455,7 @@ def bar_chart(df: pd.DataFrame, settings: dict):
     return st.altair_chart(plot)
 
 
+@timed
 def box_plot(df: pd.DataFrame, settings: dict):
     if "title" not in settings:
         settings["title"] = ""
@@ -400,6 +479,7 @@ def box_plot(df: pd.DataFrame, settings: dict):
     return st.altair_chart(plot)
 
 
+@timed
 def histogram(df: pd.DataFrame, settings: dict):
     def get_x_domain():
         x_domain = [df[settings["x"]].min(), df[settings["x"]].max()]
@@ -436,35 +516,47 @@ def histogram(df: pd.DataFrame, settings: dict):
     return st.altair_chart(plot)
 
 
-def line_chart_3d(df, settings):
-    def value_to_xy(value, month):
-        v = value - settings["y_domain"][0]
-        origin = (np.abs(settings["y_domain"][0]) + settings["y_domain"][1]) / 2
-        theta_radians = 2 * np.pi / 12 * (month - 1)
-        x = origin + v * np.cos(theta_radians)
-        y = origin + v * np.sin(theta_radians)
-        return x, y
-
-    rad_max: float = np.abs(settings["y_domain"][0]) + settings["y_domain"][1] + 1
-    df["x"] = 0
-    df["y"] = 0
-    df["z"] = 0
-
-    for index, row in df.iterrows():
-        x, y = value_to_xy(row[settings["value"]], row[settings["month"]])
-        z = row[settings["year"]] + row[settings["month"]] / 12
-        df.loc[index, "x"] = x
-        df.loc[index, "y"] = y
-        df.loc[index, "z"] = z
-
+@timed
+def get_spiral_data(df, settings):
+    """
+    Returns a copy of df with the x, y, z coordinates and hover text of the
+    spiral: one turn per year, the angle is given by settings["month"] and the
+    radius by the value. For long series such as daily values, settings
+    "period" (e.g. 366 for day of year) sets the positions per turn and
+    "max_points" decimates the series to at most this number of points.
+    """
+    period = settings.get("period", 12)
+    max_points = settings.get("max_points")
+    if max_points and len(df) > max_points:
+        step = int(np.ceil(len(df) / max_points))
+        df = df.iloc[::step]
+    df = df.copy()
+
+    value = df[settings["value"]].to_numpy(dtype=float)
+    month = df[settings["month"]].to_numpy(dtype=float)
+    year = df[settings["year"]].to_numpy(dtype=float)
+    v = value - settings["y_domain"][0]
+    origin = (np.abs(settings["y_domain"][0]) + settings["y_domain"][1]) / 2
+    theta_radians = 2 * np.pi / period * (month - 1)
+    df["x"] = origin + v * np.cos(theta_radians)
+    df["y"] = origin + v * np.sin(theta_radians)
+    df["z"] = year + month / period
     df["text"] = (
-        df[settings["year"]].map(str)
+        df[settings["year"]].astype(str)
         + "/"
-        + df[settings["month"]].map(str)
+        + df[settings["month"]].astype(str)
         + ": "
-        + df[settings["value"]].round(1).map(str)
+        + df[settings["value"]].round(1).astype(str)
         + " °C"
     )
+    return df
+
+
+@timed
+def line_chart_3d(df, settings):
+    import plotly.express as px
+
+    df = get_spiral_data(df, settings)
 
     # color schemas: https://plotly.com/python/colorscales/#colorscales-in-dash
     fig = px.scatter_3d(
@@ -0,0 +1,204 @@
+import os
+import pandas as pd
+import pyarrow.dataset as ds
+
+import store
+
+RECORDS_FILE = "climate-data-ncbn-records.parquet"
+# number of highest and lowest values kept per station, parameter and period
+TOP_K = 5
+# record periods: all-time, calendar month and calendar day (month * 100 + day)
+RECORD_SCOPES = ["year", "month", "day"]
+RECORD_KINDS = ["max", "min"]
+INDEX_KEYS = ["station", "parameter", "scope", "key", "kind"]
+
+
+def get_index_file(folder: str = None):
+    return store.get_derived_file(RECORDS_FILE, folder)
+
+
+def index_exists():
+    return os.path.exists(get_index_file())
+
+
+def get_scope_key(dates: pd.Series, scope: str):
+    """Returns the calendar period of each date: 0 for all-time records, the
+    month or month * 100 + day of month, so Feb 29 is a day of its own."""
+    if scope == "year":
+        return pd.Series(0, index=dates.index, dtype="int16")
+    if scope == "month":
+        return dates.dt.month.astype("int16")
+    return (dates.dt.month * 100 + dates.dt.day).astype("int16")
+
+
+def rank_records(df: pd.DataFrame, k: int = TOP_K):
+    """
+    Keeps the k highest (kind max) or lowest (kind min) values of each station,
+    parameter and period and numbers them from 1. Equal values are ranked by
+    date, the record is held by the date it was first reached.
+
+    :param df: candidate rows with the INDEX_KEYS, value and date
+    :param k: number of values kept
+    :return: DataFrame with the INDEX_KEYS, rank, value and date
+    """
+    ranked = []
+    for kind in RECORD_KINDS:
+        kind_df = df[df["kind"] == kind]
+        kind_df = kind_df.sort_values(
+            by=["value", "date"], ascending=[kind == "min", True], kind="stable"
+        )
+        rank = kind_df.groupby(INDEX_KEYS, observed=True).cumcount() + 1
+        ranked.append(kind_df.assign(rank=rank)[rank <= k])
+    return sort_index(pd.concat(ranked, ignore_index=True))
+
+
+def sort_index(df: pd.DataFrame):
+    for column in ["station", "parameter", "scope", "kind"]:
+        df[column] = df[column].astype("category")
+    df["rank"] = df["rank"].astype("int8")
+    df = df.sort_values(by=INDEX_KEYS + ["rank"], ignore_index=True)
+    return df[INDEX_KEYS + ["rank", "value", "date"]]
+
+
+def build_index(df: pd.DataFrame, parameters: list, k: int = TOP_K):
+    """
+    Builds the extremes index of the daily values: the k highest and lowest
+    values with their dates for each station, parameter and record period.
+
+    :param df: daily data with station, date and the parameters
+    :param parameters: parameters to be indexed
+    :param k: number of values kept per period
+    :return: DataFrame, see rank_records
+    """
+    stations = df["station"].astype("category")
+    columns = {"station": stations, "date": df["date"]}
+    # each station and period is numbered by one integer, grouping by it is
+    # faster than grouping by station and period
+    for scope in RECORD_SCOPES:
+        key = get_scope_key(df["date"], scope)
+        columns[scope] = stations.cat.codes.astype("int32") * 10000 + key
+    ranked = []
+    for par in parameters:
+        par_df = pd.DataFrame(dict(columns, value=df[par].astype("float32")))
+        par_df = par_df.dropna(subset=["value"])
+        for kind in RECORD_KINDS:
+            # one sort per parameter and kind, each period is ranked from it
+            sorted_df = par_df.sort_values(
+                by=["value", "date"], ascending=[kind == "min", True], kind="stable"
+            )
+            for scope in RECORD_SCOPES:
+                rank = sorted_df.groupby(scope).cumcount() + 1
+                scope_df = sorted_df[rank <= k]
+                ranked.append(
+                    pd.DataFrame(
+                        {
+                            "station": scope_df["station"],
+                            "parameter": par,
+                            "scope": scope,
+                            "key": (scope_df[scope] % 10000).astype("int16"),
+                            "kind": kind,
+                            "rank": rank[rank <= k],
+                            "value": scope_df["value"],
+                            "date": scope_df["date"],
+                        }
+                    )
+                )
+    return sort_index(pd.concat(ranked, ignore_index=True))
+
+
+def update_index(index_df: pd.DataFrame, df: pd.DataFrame, parameters: list):
+    """
+    Merges new daily rows into the index: the top values of the new rows are
+    ranked together with the stored values of the same periods, values of
+    dates already in the index are replaced. Only the new rows and the periods
+    they touch are processed.
+
+    :param index_df: existing index, see build_index
+    :param df: new daily data
+    :param parameters: parameters to be indexed
+    :return: updated index
+    """
+    candidates = build_index(df, parameters)
+    groups = candidates[INDEX_KEYS].drop_duplicates()
+    index_df = index_df.merge(groups, on=INDEX_KEYS, how="left", indicator=True)
+    touched = index_df["_merge"] == "both"
+    index_df = index_df.drop(columns="_merge")
+    df = pd.concat([index_df[touched], candidates], ignore_index=True)
+    df = df.drop_duplicates(subset=INDEX_KEYS + ["date"], keep="last")
+    return sort_index(
+        pd.concat([index_df[~touched], rank_records(df)], ignore_index=True)
+    )
+
+
+def write_index(
+    df: pd.DataFrame, parameters: list, folder: str, replace_all: bool = True
+):
+    """
+    Writes the extremes index.
+
+    :param df: daily data, all data if replace_all, otherwise the new or
+               changed rows
+    :param parameters: parameters to be indexed
+    :param folder: dataset directory, see store.create_staging_dir
+    :param replace_all: if False, df is merged into the existing index
+    """
+    index_file = get_index_file(folder)
+    if replace_all or not os.path.exists(index_file):
+        index_df = build_index(df, parameters)
+    else:
+        index_df = update_index(pd.read_parquet(index_file), df, parameters)
+    store.write_parquet(index_df, index_file)
+
+
+def read_records(
+    parameters: list,
+    scope: str,
+    kind: str,
+    stations: list = [],
+    max_rank: int = TOP_K,
+):
+    """
+    Reads the ranked extremes of the parameters for a record period and kind.
+
+    :param parameters: parameters to be read
+    :param scope: one of RECORD_SCOPES
+    :param kind: max or min
+    :param stations: stations to be read, all if empty
+    :param max_rank: only values up to this rank are read, 1 for the records
+    :return: DataFrame, see rank_records
+    """
+    expression = (
+        ds.field("parameter").isin(parameters)
+        & (ds.field("scope") == scope)
+        & (ds.field("kind") == kind)
+        & (ds.field("rank") <= max_rank)
+    )
+    if stations != []:
+        expression = expression & ds.field("station").isin(stations)
+    dataset = ds.dataset(get_index_file(), format="parquet")
+    return dataset.to_table(filter=expression).to_pandas()
+
+
+def get_records_set(year: int, parameters: list, scope: str, kind: str, stations=[]):
+    """
+    Returns the records set in year, e.g. all-time maximum temperatures of this
+    year, with the value and date of the runner-up, which is the former record
+    unless it was set in the same year.
+
+    :param year: year the records were set in
+    :param parameters: parameters to be read
+    :param scope: one of RECORD_SCOPES
+    :param kind: max or min
+    :param stations: stations to be read, all if empty
+    :return: DataFrame with station, parameter, key, value, date and the value
+             and date of rank 2
+    """
+    df = read_records(parameters, scope, kind, stations, max_rank=2)
+    keys = ["station", "parameter", "key"]
+    records_df = df[(df["rank"] == 1) & (df["date"].dt.year == year)]
+    runner_up_df = df[df["rank"] == 2][keys + ["value", "date"]]
+    records_df = records_df[keys + ["value", "date"]].merge(
+        runner_up_df, on=keys, how="left", suffixes=("", "_2")
+    )
+    records_df = records_df.sort_values(by=keys, ignore_index=True)
+    return records_df[keys + ["value", "date", "value_2", "date_2"]]
@@ -0,0 +1,133 @@
+"""
+Background refresh of the NBCN data, decoupled from the page loads. The data
+is refreshed every REFRESH_HOURS by a scheduler thread started once per server
+process (start_scheduler) or by a separate daemon:
+
+    python refresh.py            refreshes the data once
+    python refresh.py --daemon   refreshes the data on schedule
+
+Set NBCN_REFRESH_SCHEDULER=0 for the server processes if the daemon is used.
+A refresh builds the dataset and the derived tables in a staging directory
+and swaps it in atomically, see store.swap_dataset. Only one process
+refreshes at a time, the others skip while LOCK_FILE exists. The status of
+the last refresh is kept in STATUS_FILE and shared by all processes.
+"""
+
+import os
+import json
+import time
+import argparse
+import datetime
+import threading
+import traceback
+import streamlit as st
+
+import store
+import nbcn_data
+
+REFRESH_HOURS = float(os.environ.get("NBCN_REFRESH_HOURS", 6))
+SCHEDULER_ENABLED = os.environ.get("NBCN_REFRESH_SCHEDULER", "1") == "1"
+# a failed refresh is retried after this time
+RETRY_MINUTES = 30
+# the scheduler checks if a refresh is due in this interval
+CHECK_SECONDS = 60
+# a lock older than this is left over from a crashed refresh
+LOCK_TIMEOUT_HOURS = 2
+STATUS_FILE = "./data/refresh-status.json"
+LOCK_FILE = "./data/refresh.lock"
+
+
+def read_status():
+    """
+    Returns the status of the last refresh: state (running, ok or failed),
+    last_refresh (end of the last successful refresh), last_attempt, seconds
+    and error. An empty dict is returned if the data was never refreshed.
+    """
+    if not os.path.exists(STATUS_FILE):
+        return {}
+    with open(STATUS_FILE, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def write_status(status: dict):
+    temp_file = f"{STATUS_FILE}.{os.getpid()}.tmp"
+    with open(temp_file, "w", encoding="utf-8") as file:
+        json.dump(status, file, indent=4)
+    os.replace(temp_file, STATUS_FILE)
+
+
+def acquire_lock():
+    """Creates LOCK_FILE, returns False if another refresh holds it."""
+    return store.acquire_lock(LOCK_FILE, LOCK_TIMEOUT_HOURS * 3600)
+
+
+def is_due(status: dict):
+    now = datetime.datetime.now()
+    if status.get("state") == "failed":
+        last_attempt = datetime.datetime.fromisoformat(status["last_attempt"])
+        return now - last_attempt > datetime.timedelta(minutes=RETRY_MINUTES)
+    if not status.get("last_refresh"):
+        return True
+    last_refresh = datetime.datetime.fromisoformat(status["last_refresh"])
+    return now - last_refresh > datetime.timedelta(hours=REFRESH_HOURS)
+
+
+def refresh():
+    """
+    Refreshes the data, see nbcn_data.refresh_data, and records the status.
+    The cached shared data and query results of all processes are keyed by
+    the data version and need no clearing.
+
+    :return: False if another process is refreshing, else True
+    """
+    if not acquire_lock():
+        return False
+    status = read_status()
+    now = datetime.datetime.now().isoformat(timespec="seconds")
+    status.update(state="running", last_attempt=now, error=None)
+    write_status(status)
+    start_time = time.perf_counter()
+    try:
+        nbcn_data.refresh_data()
+        now = datetime.datetime.now().isoformat(timespec="seconds")
+        status.update(state="ok", last_refresh=now)
+    except Exception as e:
+        traceback.print_exc()
+        status.update(state="failed", error=f"{type(e).__name__}: {e}")
+    finally:
+        status["seconds"] = round(time.perf_counter() - start_time, 1)
+        write_status(status)
+        os.remove(LOCK_FILE)
+    print(f"refresh: {status['state']} after {status['seconds']}s")
+    return True
+
+
+def run_scheduler(stop: threading.Event = None):
+    """Refreshes the data whenever it is due, until stop is set."""
+    stop = stop or threading.Event()
+    while not stop.is_set():
+        if is_due(read_status()):
+            refresh()
+        stop.wait(CHECK_SECONDS)
+
+
+@st.cache_resource(show_spinner=False)
+def start_scheduler():
+    """Starts the scheduler thread of the server process, once."""
+    thread = threading.Thread(target=run_scheduler, name="refresh", daemon=True)
+    thread.start()
+    return thread
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Refreshes the NBCN data.")
+    parser.add_argument("--daemon", action="store_true", help="refresh on schedule")
+    args = parser.parse_args()
+    if args.daemon:
+        run_scheduler()
+    elif not refresh():
+        print("refresh: skipped, another refresh is running")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+"""
+Builds report bundles of the NBCN analyses without the streamlit app: a
+summary table and a Mann-Kendall trend table for all selected stations, and
+a heatmap and time series chart per station, rendered in a process pool.
+
+Usage, from the repository root:
+    python report.py --parameter tre200d0 --stations BAS BER --years 1961 2022
+
+Charts are written as html by default, png and svg need the optional
+package vl-convert-python. Tables are written as csv and/or parquet.
+"""
+
+import os
+import json
+import time
+import argparse
+import multiprocessing
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import store
+import refresh
+from nbcn_data import (
+    PARAMETERS,
+    PARAMETERS_AGG_DICT,
+    get_aggregated_data,
+    read_filtered_data,
+)
+from nbcn import MIN_POINTS
+from trend import seasonal_mann_kendall
+from plots import get_heatmap, get_time_series_line
+from helper import add_date_column, remove_unit
+
+STATIONS_FILE = "./data/1_download_url_nbcn_homogen.csv"
+LANG_FILE = "./lang/nbcn.json"
+OUTPUT_DIR = "./reports"
+CHART_FORMATS = ["html", "png", "svg"]
+TABLE_FORMATS = ["csv", "parquet"]
+TIME_AGGREGATIONS = ["day", "week", "month", "year", "decade"]
+
+
+def get_station_names():
+    df = pd.read_csv(STATIONS_FILE, sep=";")
+    return dict(zip(df["Abbreviation"], df["Station"]))
+
+
+def get_parameter_label(parameter: str, language: str = "en"):
+    with open(LANG_FILE, "r", encoding="utf-8") as file:
+        lang = json.load(file)[language]
+    return lang[f"{parameter}-s"]
+
+
+def write_table(df: pd.DataFrame, file_base: str, formats: list):
+    files = []
+    for table_format in formats:
+        file = f"{file_base}.{table_format}"
+        if table_format == "csv":
+            df.to_csv(file, index=False)
+        else:
+            df.to_parquet(file, index=False, engine="pyarrow")
+        files.append(file)
+    return files
+
+
+def write_chart(chart, file_base: str, formats: list):
+    files = []
+    for chart_format in formats:
+        file = f"{file_base}.{chart_format}"
+        try:
+            chart.save(file)
+            files.append(file)
+        except Exception as ex:
+            print(f"{file} not written: {ex}")
+    return files
+
+
+def get_filters(stations: list, years: list):
+    return {"stations": stations, "years": years}
+
+
+def build_summary_table(args, min_year: int, max_year: int):
+    """Minimum, maximum, mean and standard deviation per station."""
+    df = get_aggregated_data(
+        get_filters(args.stations, args.years),
+        [args.parameter],
+        args.time_aggregation,
+        min_year,
+        max_year,
+        update=False,
+    )
+    agg_funcs = ["min", "max", "mean", "std"]
+    df = df.groupby("station", observed=True)[args.parameter].agg(agg_funcs)
+    df = df.reset_index()
+    df.insert(1, "station name", df["station"].map(get_station_names()))
+    return df
+
+
+def build_trend_table(args, min_year: int, max_year: int):
+    """Seasonal Mann-Kendall test on the monthly values of all stations."""
+    df = get_aggregated_data(
+        get_filters(args.stations, args.years),
+        [args.parameter],
+        "month",
+        min_year,
+        max_year,
+        update=False,
+    )
+    return seasonal_mann_kendall(df, [args.parameter], min_points=MIN_POINTS)
+
+
+def build_station_report(job: dict):
+    """
+    Writes the heatmap of the monthly values and the time series chart of one
+    station. Runs in a worker process, the data is read by the worker.
+
+    :param job: station, parameter, time_aggregation, years, year range,
+                output folder and formats
+    :return: station, written files and seconds used
+    """
+    start_time = time.perf_counter()
+    station = job["station"]
+    parameter = job["parameter"]
+    label = get_parameter_label(parameter)
+    title = f"{job['station_name']} ({station})"
+    filters = get_filters([station], job["years"])
+    year_range = job["min_year"], job["max_year"]
+    files = []
+
+    df = get_aggregated_data(filters, [parameter], "month", *year_range, update=False)
+    df = df.rename(columns={parameter: remove_unit(label)}).round(2)
+    settings = {
+        "x": "month:N",
+        "y": "year:N",
+        "color": remove_unit(label),
+        "width": 800,
+        "height": 400,
+        "tooltip": ["month", "year", remove_unit(label)],
+        "show_numbers": False,
+        "title": title,
+    }
+    file_base = os.path.join(job["output_dir"], f"heatmap-{station}")
+    files += write_chart(get_heatmap(df, settings), file_base, job["chart_formats"])
+
+    time_aggregation = job["time_aggregation"]
+    if time_aggregation in ("day", "week"):
+        # the daily rows hold the date, see NCBN.show_time_series
+        columns = ["station", "date", "year", time_aggregation, parameter]
+        df = read_filtered_data(filters, columns, [parameter])
+        df = add_date_column(df, time_aggregation)
+        if time_aggregation == "week":
+            df = (
+                df.groupby(["station", "year", "week", "date"], observed=True)
+                .agg({parameter: PARAMETERS_AGG_DICT[parameter]})
+                .reset_index()
+            )
+    else:
+        df = get_aggregated_data(
+            filters, [parameter], time_aggregation, *year_range, update=False
+        )
+        df = add_date_column(df, time_aggregation)
+    df = df.rename(columns={parameter: remove_unit(label)})
+    settings = {
+        "x": "date",
+        "y": remove_unit(label),
+        "color": "station",
+        "width": 800,
+        "height": 400,
+        "y_title": label,
+        "x_title": "",
+        "y_domain": [df[remove_unit(label)].min(), df[remove_unit(label)].max()],
+        "title": title,
+        "tooltip": ["date", remove_unit(label)],
+    }
+    file_base = os.path.join(job["output_dir"], f"time-series-{station}")
+    chart = get_time_series_line(df, settings)
+    files += write_chart(chart, file_base, job["chart_formats"])
+    return station, files, time.perf_counter() - start_time
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Builds NBCN report bundles.")
+    parser.add_argument("--parameter", default="tre200d0", choices=PARAMETERS)
+    parser.add_argument("--stations", nargs="*", default=[], help="all if empty")
+    parser.add_argument("--years", nargs=2, type=int, default=[])
+    parser.add_argument(
+        "--time-aggregation", default="month", choices=TIME_AGGREGATIONS
+    )
+    parser.add_argument("--charts", nargs="*", default=["html"], choices=CHART_FORMATS)
+    parser.add_argument("--tables", nargs="*", default=["csv"], choices=TABLE_FORMATS)
+    parser.add_argument("--output-dir", default=OUTPUT_DIR)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument(
+        "--update", action="store_true", help="download recent data first"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    if args.update and not refresh.refresh():
+        print("update skipped, another refresh is running")
+    min_year, max_year = store.get_year_range()
+    station_names = get_station_names()
+    if args.stations == []:
+        args.stations = sorted(
+            store.get_dataset()
+            .to_table(columns=["station"])["station"]
+            .unique()
+            .to_pylist()
+        )
+    output_dir = os.path.join(args.output_dir, args.parameter)
+    os.makedirs(output_dir, exist_ok=True)
+
+    start_time = time.perf_counter()
+    files = []
+    summary_df = build_summary_table(args, min_year, max_year)
+    files += write_table(summary_df, os.path.join(output_dir, "summary"), args.tables)
+    trend_df = build_trend_table(args, min_year, max_year)
+    files += write_table(trend_df, os.path.join(output_dir, "trend"), args.tables)
+
+    jobs = [
+        {
+            "station": station,
+            "station_name": station_names.get(station, station),
+            "parameter": args.parameter,
+            "time_aggregation": args.time_aggregation,
+            "years": args.years,
+            "min_year": min_year,
+            "max_year": max_year,
+            "output_dir": output_dir,
+            "chart_formats": args.charts,
+        }
+        for station in args.stations
+    ]
+    # spawned workers do not inherit the pyarrow thread pools of this process
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=context) as pool:
+        futures = [pool.submit(build_station_report, job) for job in jobs]
+        for future in as_completed(futures):
+            station, station_files, seconds = future.result()
+            files += station_files
+            print(f"{station}: {len(station_files)} files in {seconds:.1f}s")
+    seconds = time.perf_counter() - start_time
+    print(f"{len(files)} files written to {output_dir} in {seconds:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
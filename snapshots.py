@@ -0,0 +1,222 @@
+"""
+Versioned snapshots of the downloaded data, the previous (verified) and the
+current data. Each write creates a new parquet file in SNAPSHOT_DIR: it is
+written to a temporary file, flushed to disk and renamed, so a crash or a
+concurrent writer never leaves a truncated file. MANIFEST_FILE lists the
+versions of each snapshot with the sha256 hash of their content, the version
+is the start of the hash. KEEP_VERSIONS versions are kept.
+
+Readers pin the versions they read (pin), e.g. to read the previous and the
+current data of the same refresh, or to key cached results.
+
+    python snapshots.py                           lists the versions
+    python snapshots.py --verify                  checks the content hashes
+    python snapshots.py --rollback current <version>
+"""
+
+import os
+import json
+import hashlib
+import argparse
+import datetime
+import pandas as pd
+
+import store
+
+SNAPSHOT_DIR = "./data/snapshots"
+MANIFEST_FILE = "./data/snapshots/manifest.json"
+# held by every process changing the manifest, see store.file_lock
+MANIFEST_LOCK_FILE = "./data/snapshots/manifest.lock"
+KEEP_VERSIONS = int(os.environ.get("NBCN_KEEP_SNAPSHOTS", 3))
+# target files of nbcn_data.DATA_DICT written before the snapshots were
+# introduced, they are read as long as no snapshot exists
+LEGACY_FILES = {
+    "current": "./data/climate-data-ncbn-current.parquet",
+    "previous": "./data/climate-data-ncbn-previous.parquet",
+}
+# fetch manifests of the snapshots with the etag, last-modified and last date
+# of each station file, see nbcn_data.read_manifest
+FETCH_MANIFEST_FILES = {
+    name: file.replace(".parquet", ".manifest.json")
+    for name, file in LEGACY_FILES.items()
+}
+
+
+def fsync_dir(path: str):
+    """Flushes the directory entry of a renamed file, not supported on windows."""
+    if hasattr(os, "O_DIRECTORY"):
+        handle = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(handle)
+        finally:
+            os.close(handle)
+
+
+def write_file_atomic(temp_file: str, file: str):
+    """Flushes temp_file to disk and renames it to file."""
+    with open(temp_file, "rb+") as f:
+        os.fsync(f.fileno())
+    os.replace(temp_file, file)
+    fsync_dir(os.path.dirname(file))
+
+
+def get_hash(file: str):
+    sha256 = hashlib.sha256()
+    with open(file, "rb") as f:
+        for block in iter(lambda: f.read(1024**2), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def read_manifest():
+    """
+    Returns the manifest: for each snapshot name the current version and the
+    list of kept versions, newest first, with file, sha256, rows, bytes and
+    creation time.
+    """
+    if not os.path.exists(MANIFEST_FILE):
+        return {}
+    with open(MANIFEST_FILE, "r", encoding="utf-8") as file:
+        return json.load(file)
+
+
+def write_manifest(manifest: dict):
+    temp_file = f"{MANIFEST_FILE}.{os.getpid()}.tmp"
+    with open(temp_file, "w", encoding="utf-8") as file:
+        json.dump(manifest, file, indent=4)
+    write_file_atomic(temp_file, MANIFEST_FILE)
+
+
+def write_snapshot(name: str, df: pd.DataFrame):
+    """
+    Writes df as a new version of snapshot name and makes it the current
+    version. The oldest versions are removed, KEEP_VERSIONS are kept.
+
+    :param name: current or previous
+    :param df: data of the snapshot
+    :return: version of the snapshot
+    """
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    temp_file = os.path.join(SNAPSHOT_DIR, f"{name}.{os.getpid()}.tmp")
+    df.to_parquet(temp_file, index=False, engine="pyarrow")
+    sha256 = get_hash(temp_file)
+    version = sha256[:16]
+    file_name = f"{name}-{version}.parquet"
+    write_file_atomic(temp_file, os.path.join(SNAPSHOT_DIR, file_name))
+    with store.file_lock(MANIFEST_LOCK_FILE):
+        manifest = read_manifest()
+        entry = manifest.setdefault(name, {"version": None, "versions": []})
+        versions = [x for x in entry["versions"] if x["version"] != version]
+        versions.insert(
+            0,
+            {
+                "version": version,
+                "file": file_name,
+                "sha256": sha256,
+                "rows": len(df),
+                "bytes": os.path.getsize(os.path.join(SNAPSHOT_DIR, file_name)),
+                "created": datetime.datetime.now().isoformat(timespec="seconds"),
+            },
+        )
+        entry.update(version=version, versions=versions[:KEEP_VERSIONS])
+        write_manifest(manifest)
+    # removed after the manifest no longer lists them
+    for removed in versions[KEEP_VERSIONS:]:
+        removed_file = os.path.join(SNAPSHOT_DIR, removed["file"])
+        if os.path.exists(removed_file):
+            os.remove(removed_file)
+    return version
+
+
+def pin(manifest: dict = None):
+    """Returns the current version of each snapshot, None for legacy files."""
+    manifest = read_manifest() if manifest is None else manifest
+    return {name: manifest.get(name, {}).get("version") for name in LEGACY_FILES}
+
+
+def get_file(name: str, version: str = None):
+    """
+    Returns the file of a version of snapshot name.
+
+    :param name: current or previous
+    :param version: version as returned by pin, the current version if None
+    """
+    entry = read_manifest().get(name)
+    if entry is None:
+        return LEGACY_FILES[name]
+    version = version or entry["version"]
+    for item in entry["versions"]:
+        if item["version"] == version:
+            return os.path.join(SNAPSHOT_DIR, item["file"])
+    raise KeyError(f"version {version} of snapshot {name} is not kept")
+
+
+def snapshot_exists(name: str):
+    return os.path.exists(get_file(name))
+
+
+def read_snapshot(name: str, version: str = None, **kwargs):
+    """
+    Reads a version of snapshot name.
+
+    :param name: current or previous
+    :param version: version as returned by pin, the current version if None
+    :param kwargs: passed to pd.read_parquet, e.g. columns or filters
+    :return: DataFrame
+    """
+    return pd.read_parquet(get_file(name, version), **kwargs)
+
+
+def verify():
+    """Returns the versions whose file is missing or does not match its hash."""
+    failed = []
+    for name, entry in read_manifest().items():
+        for item in entry["versions"]:
+            file = os.path.join(SNAPSHOT_DIR, item["file"])
+            if not os.path.exists(file) or get_hash(file) != item["sha256"]:
+                failed.append(f"{name} {item['version']}")
+    return failed
+
+
+def rollback(name: str, version: str):
+    """Makes a kept version the current version of snapshot name, the derived
+    data must be rebuilt afterwards, see nbcn_data.write_dataset. The fetch
+    manifest of the snapshot is removed, it describes the replaced version:
+    the next refresh reloads the station files instead of requesting only
+    changed files and days. Waits for a running refresh to finish."""
+    # imported here, refresh imports nbcn_data, which imports this module
+    import refresh
+
+    with store.file_lock(refresh.LOCK_FILE, refresh.LOCK_TIMEOUT_HOURS * 3600):
+        with store.file_lock(MANIFEST_LOCK_FILE):
+            manifest = read_manifest()
+            if version not in [x["version"] for x in manifest[name]["versions"]]:
+                raise KeyError(f"version {version} of snapshot {name} is not kept")
+            manifest[name]["version"] = version
+            write_manifest(manifest)
+        if os.path.exists(FETCH_MANIFEST_FILES[name]):
+            os.remove(FETCH_MANIFEST_FILES[name])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Lists and checks the snapshots.")
+    parser.add_argument("--verify", action="store_true")
+    parser.add_argument("--rollback", nargs=2, metavar=("NAME", "VERSION"))
+    args = parser.parse_args()
+    if args.rollback:
+        rollback(*args.rollback)
+        print("rebuild the derived data with nbcn_data.write_dataset()")
+    elif args.verify:
+        failed = verify()
+        print(f"failed: {', '.join(failed)}" if failed else "all snapshots are valid")
+    for name, entry in read_manifest().items():
+        for item in entry["versions"]:
+            current = "*" if item["version"] == entry["version"] else " "
+            print(
+                f"{current} {name:<9} {item['version']} {item['created']} "
+                f"{item['rows']:>9} rows {item['bytes'] / 1024**2:8.1f} MB"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,370 @@
+import os
+import glob
+import time
+import shutil
+import contextlib
+import hashlib
+import threading
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+
+# link to the directory of the current dataset, see swap_dataset
+DATASET_DIR = "./data/climate-data-ncbn"
+# dataset directories kept, readers may still scan the previous one
+KEEP_DATASETS = 2
+# folder of the tables derived from the daily data in each dataset directory,
+# names starting with _ are not scanned as part of the dataset
+DERIVED_DIR = "_derived"
+PARTITIONING = ds.partitioning(
+    pa.schema([("station", pa.string()), ("decade", pa.int32())]), flavor="hive"
+)
+# column order of the daily data, partition columns are restored on read
+COLUMNS = [
+    "station",
+    "date",
+    "gre000d0",
+    "hto000d0",
+    "nto000d0",
+    "prestad0",
+    "rre150d0",
+    "sre000d0",
+    "tre200d0",
+    "tre200dn",
+    "tre200dx",
+    "ure200d0",
+    "day",
+    "month",
+    "week",
+    "year",
+    "decade",
+]
+# dataset: every read scans the parquet files, memory: the dataset is read once
+# per data version into an Arrow table shared by all sessions of the process,
+# mmap: the table is memory-mapped from MAPPED_FILE and shared by all processes
+STORE_MODE = os.environ.get("NBCN_STORE", "dataset")
+MAPPED_FILE = "./data/climate-data-ncbn.arrow"
+MAPPED_LOCK_FILE = "./data/climate-data-ncbn.arrow.lock"
+# a lock older than this is left over from a crashed process
+LOCK_TIMEOUT_SECONDS = 600
+# rows per chunk of the in-memory table, the dataset has one chunk per file
+MEMORY_CHUNK_ROWS = 64 * 1024
+
+memory_table = {"version": None, "table": None}
+memory_table_lock = threading.Lock()
+
+
+def acquire_lock(lock_file: str, timeout_seconds: float = LOCK_TIMEOUT_SECONDS):
+    """
+    Creates lock_file, returns False if another process holds it. A lock older
+    than timeout_seconds is removed.
+    """
+    if os.path.exists(lock_file):
+        age = time.time() - os.path.getmtime(lock_file)
+        if age < timeout_seconds:
+            return False
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(lock_file)
+    try:
+        # O_EXCL: only one process can create the file
+        handle = os.open(lock_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    os.write(handle, str(os.getpid()).encode())
+    os.close(handle)
+    return True
+
+
+@contextlib.contextmanager
+def file_lock(lock_file: str, timeout_seconds: float = LOCK_TIMEOUT_SECONDS):
+    """Holds lock_file while the block runs, waits while another process holds
+    it, see acquire_lock."""
+    while not acquire_lock(lock_file, timeout_seconds):
+        time.sleep(0.1)
+    try:
+        yield
+    finally:
+        os.remove(lock_file)
+
+
+def write_parquet(df: pd.DataFrame, file: str):
+    """Writes df to a temporary file renamed to file, so readers never see a
+    partially written file."""
+    temp_file = f"{file}.{os.getpid()}.tmp"
+    df.to_parquet(temp_file, index=False, engine="pyarrow")
+    os.replace(temp_file, file)
+
+
+def create_staging_dir(replace_all: bool = True):
+    """
+    Creates the directory of a new dataset version next to DATASET_DIR. The
+    daily data and the derived tables are written to it, then it replaces the
+    current one, see swap_dataset.
+
+    :param replace_all: if False, the directory starts as a copy of the current
+                        one, unchanged files are hard links to its files
+    :return: path of the staging directory
+    """
+    staging_dir = f"{DATASET_DIR}.v{time.time_ns()}"
+    if not replace_all and dataset_exists():
+        shutil.copytree(
+            os.path.realpath(DATASET_DIR), staging_dir, copy_function=os.link
+        )
+    os.makedirs(os.path.join(staging_dir, DERIVED_DIR), exist_ok=True)
+    return staging_dir
+
+
+def write_dataset(df: pd.DataFrame, staging_dir: str):
+    """
+    Writes the daily data to a hive-partitioned parquet dataset, one directory
+    per station and decade, e.g. station=BAS/decade=1990. The station/decade
+    partitions included in df are replaced.
+
+    :param df: daily data, must include the partition columns station and decade
+    :param staging_dir: dataset directory, see create_staging_dir
+    """
+    df = df.astype({"decade": "int32"})
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    ds.write_dataset(
+        table,
+        staging_dir,
+        format="parquet",
+        partitioning=PARTITIONING,
+        existing_data_behavior="delete_matching",
+        basename_template="part-{i}.parquet",
+    )
+
+
+def swap_dataset(staging_dir: str):
+    """
+    Makes staging_dir the current dataset by replacing the DATASET_DIR link,
+    which is atomic: readers see either the previous or the new daily data
+    and derived tables. The oldest directories are removed, KEEP_DATASETS are
+    kept.
+
+    :param staging_dir: completely written dataset directory next to DATASET_DIR
+    """
+    if os.path.isdir(DATASET_DIR) and not os.path.islink(DATASET_DIR):
+        # dataset written before the staging directories, moved aside once
+        os.rename(DATASET_DIR, f"{DATASET_DIR}.v0")
+    temp_link = f"{DATASET_DIR}.{os.getpid()}.tmp"
+    os.symlink(os.path.basename(staging_dir), temp_link)
+    os.replace(temp_link, DATASET_DIR)
+    # directory names end with the time they were created
+    folders = glob.glob(f"{DATASET_DIR}.v*")
+    folders = sorted(folders, key=lambda x: int(x.rsplit(".v", 1)[1]))
+    for folder in folders[:-KEEP_DATASETS]:
+        shutil.rmtree(folder, ignore_errors=True)
+    if STORE_MODE == "mmap":
+        # written now instead of by the first read of the new version
+        open_mapped_file(os.path.basename(staging_dir))
+
+
+def dataset_exists():
+    return os.path.exists(DATASET_DIR)
+
+
+def get_data_version():
+    """
+    Returns the version of the dataset, used to key cached results computed
+    from the data: the name of the directory DATASET_DIR links to, every write
+    creates a new one. For a dataset written before the links were used, a
+    hash over the name, size and modification time of all dataset files.
+    """
+    if os.path.islink(DATASET_DIR):
+        return os.path.basename(os.readlink(DATASET_DIR))
+    version = hashlib.sha1()
+    for root, dirs, files in sorted(os.walk(DATASET_DIR)):
+        for file in sorted(files):
+            stat = os.stat(os.path.join(root, file))
+            version.update(f"{root}/{file}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return version.hexdigest()
+
+
+def get_version_dir(version: str = None):
+    """Returns the dataset directory of version, the current one if None or
+    for a dataset written before the links were used."""
+    if version is None or not os.path.islink(DATASET_DIR):
+        return os.path.realpath(DATASET_DIR)
+    return os.path.join(os.path.dirname(DATASET_DIR), version)
+
+
+def get_derived_file(file_name: str, folder: str = None):
+    """
+    Returns the path of a table derived from the daily data, e.g. an aggregate
+    cube. It is kept with the daily data of the same version and published
+    by the same swap.
+
+    :param file_name: name of the parquet file
+    :param folder: dataset directory, the current one if None
+    """
+    folder = get_version_dir() if folder is None else folder
+    return os.path.join(folder, DERIVED_DIR, file_name)
+
+
+def get_dataset(version: str = None):
+    # the link is resolved once, a scan is not affected by a later swap
+    path = get_version_dir(version)
+    return ds.dataset(path, format="parquet", partitioning=PARTITIONING)
+
+
+def read_table(version: str = None):
+    """
+    Reads all daily data of version, the current one if None, into an Arrow
+    table. The parameters keep their scaled
+    int16 storage type and station is dictionary encoded, so the table is about
+    the size of the parquet files' content. The small chunks of the partition
+    files are merged into chunks of MEMORY_CHUNK_ROWS, filters are then
+    evaluated over a few large arrays.
+    """
+    table = get_dataset(version).to_table(columns=COLUMNS)
+    station = table.column("station").dictionary_encode()
+    table = table.set_column(0, "station", station).unify_dictionaries()
+    batches = table.combine_chunks().to_batches(MEMORY_CHUNK_ROWS)
+    return pa.Table.from_batches(batches, schema=table.schema)
+
+
+def write_mapped_file(version: str):
+    """
+    Writes all daily data of version to MAPPED_FILE as an uncompressed Arrow
+    IPC file, which is memory-mapped without decoding. The version is stored
+    in the schema metadata. The file is written to a temporary file and
+    renamed, processes that mapped the previous file keep reading it until
+    they reopen.
+
+    :param version: data version, see get_data_version
+    """
+    table = read_table(version)
+    table = table.replace_schema_metadata({"data_version": version})
+    temp_file = f"{MAPPED_FILE}.{os.getpid()}.tmp"
+    with pa.OSFile(temp_file, "wb") as sink:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table, max_chunksize=MEMORY_CHUNK_ROWS)
+    os.replace(temp_file, MAPPED_FILE)
+
+
+def open_mapped_file(version: str):
+    """
+    Returns the table of MAPPED_FILE. The buffers point into the mapped file,
+    its pages are loaded on access and shared with every process mapping it.
+    The file is rewritten first if it is missing or of another data version.
+
+    Only one process rewrites the file, the others wait for it and map the
+    rewritten file.
+
+    :param version: data version, see get_data_version
+    """
+    table = read_mapped_file(version)
+    if table is None:
+        with file_lock(MAPPED_LOCK_FILE):
+            # another process may have rewritten the file while this one waited
+            table = read_mapped_file(version)
+            if table is None:
+                write_mapped_file(version)
+                table = read_mapped_file(version)
+    return table
+
+
+def read_mapped_file(version: str):
+    """Returns the table of MAPPED_FILE, None if the file is missing or of
+    another data version."""
+    if not os.path.exists(MAPPED_FILE):
+        return None
+    reader = pa.ipc.open_file(pa.memory_map(MAPPED_FILE, "r"))
+    if (reader.schema.metadata or {}).get(b"data_version") != version.encode():
+        return None
+    return reader.read_all()
+
+
+def get_table():
+    """
+    Returns all daily data as an Arrow table, read once per data version:
+    decoded from the dataset (STORE_MODE memory) or mapped from MAPPED_FILE
+    (STORE_MODE mmap).
+    """
+    version = get_data_version()
+    with memory_table_lock:
+        if memory_table["version"] != version:
+            # the previous table is released before the new one is read
+            memory_table.update(version=None, table=None)
+            if STORE_MODE == "mmap":
+                table = open_mapped_file(version)
+            else:
+                table = read_table(version)
+            memory_table.update(version=version, table=table)
+        return memory_table["table"]
+
+
+def get_source():
+    """Returns the dataset reads are answered from, see STORE_MODE."""
+    if STORE_MODE in ("memory", "mmap"):
+        return ds.dataset(get_table())
+    return get_dataset()
+
+
+def get_filter_expression(filters: dict, not_null: list = []):
+    """
+    Converts the filter dict built by helper.show_filter into a pyarrow dataset
+    expression. Year filters are repeated on the decade partition key, so
+    partitions outside the selected period are not read at all.
+
+    :param filters: dict with the optional keys stations, years, decades, year,
+                    month, months and region
+    :param not_null: columns whose missing values are filtered out
+    :return: pyarrow expression or None if no filter is set
+    """
+    expressions = [ds.field(column).is_valid() for column in not_null]
+    if "stations" in filters and filters["stations"] != []:
+        expressions.append(ds.field("station").isin(filters["stations"]))
+    if "years" in filters and filters["years"] != []:
+        first_year, last_year = filters["years"]
+        expressions.append(ds.field("decade") >= (first_year // 10) * 10)
+        expressions.append(ds.field("decade") <= (last_year // 10) * 10)
+        expressions.append(ds.field("year") >= first_year)
+        expressions.append(ds.field("year") <= last_year)
+    if "decades" in filters and filters["decades"] != []:
+        expressions.append(ds.field("decade") >= filters["decades"][0])
+        expressions.append(ds.field("decade") <= filters["decades"][1])
+    if "year" in filters:
+        expressions.append(ds.field("decade") == (filters["year"] // 10) * 10)
+        expressions.append(ds.field("year") == filters["year"])
+    if "month" in filters:
+        expressions.append(ds.field("month") == filters["month"])
+    if "region" in filters and filters["region"] != []:
+        expressions.append(ds.field("climate region").isin(filters["region"]))
+    if "months" in filters and filters["months"] != []:
+        expressions.append(ds.field("month").isin(filters["months"]))
+
+    if expressions == []:
+        return None
+    expression = expressions[0]
+    for item in expressions[1:]:
+        expression = expression & item
+    return expression
+
+
+def read_data(filters: dict = {}, columns: list = COLUMNS, not_null: list = []):
+    """
+    Reads the rows matching filters from the partitioned dataset or the
+    in-memory table. The filters are evaluated as one expression and only the
+    requested columns are materialized, in a single pass over the data.
+
+    :param filters: filter dict, see get_filter_expression
+    :param columns: columns to be read
+    :param not_null: columns whose missing values are filtered out
+    :return: DataFrame with the filtered daily data
+    """
+    table = get_source().to_table(
+        columns=columns, filter=get_filter_expression(filters, not_null)
+    )
+    # keeps the scaled Int16 parameter columns, see nbcn_data.STORAGE_SPECS
+    return table.to_pandas(types_mapper={pa.int16(): pd.Int16Dtype()}.get)
+
+
+def get_year_range():
+    """
+    Returns the first and last year of the dataset, only the year column is read.
+    """
+    result = pc.min_max(get_source().to_table(columns=["year"])["year"])
+    return int(result["min"].as_py()), int(result["max"].as_py())
@@ -0,0 +1,224 @@
+"""
+Optional timing instrumentation of the app. Functions decorated with timed
+record a span per call during a script run: data access, filtering,
+aggregation, the show_* views and the chart functions. The self time of a
+chart function, without its instrumented callees, is mostly the
+serialization of the chart by streamlit.
+
+Set the environment variable NBCN_TIMING=1 to enable it, otherwise timed
+returns the functions unchanged. At the end of each run the spans are
+appended to TIMING_LOG (json lines), which is rotated once it exceeds
+TIMING_LOG_MAX_MB. The totals of the process are written to its own metrics
+file next to METRICS_FILE, e.g. metrics-1234.prom, in the Prometheus text
+format with a pid label, e.g. for the textfile collector of the node
+exporter: the processes of a server or the report workers never overwrite
+each other's counters. show_panel shows the breakdown of the run in the
+sidebar. The counters of the query cache (cache.get_query_stats) are
+reported with the spans.
+"""
+
+import os
+import json
+import time
+import datetime
+import functools
+import threading
+import pandas as pd
+import streamlit as st
+
+import store
+
+ENABLED = os.environ.get("NBCN_TIMING", "0") == "1"
+TIMING_LOG = os.environ.get("NBCN_TIMING_LOG", "./data/timing.jsonl")
+# the log is renamed to TIMING_LOG.1 at this size, replacing the previous one
+TIMING_LOG_MAX_MB = float(os.environ.get("NBCN_TIMING_LOG_MB", 50))
+METRICS_FILE = os.environ.get("NBCN_METRICS_FILE", "./data/metrics.prom")
+
+# each session runs its script in its own thread
+run_state = threading.local()
+# span name -> [calls, seconds, self seconds] of all runs of the process
+totals = {}
+totals_lock = threading.Lock()
+run_totals = {"runs": 0, "seconds": 0.0}
+# latest counters of the query cache, see cache.get_query_stats
+cache_stats = {}
+CACHE_METRICS = {
+    "hits": ("counter", "Query results read from the cache."),
+    "misses": ("counter", "Query results computed."),
+    "evictions": ("counter", "Query results removed from the full cache."),
+    "bytes": ("gauge", "Bytes of the cached query results."),
+    "entries": ("gauge", "Number of cached query results."),
+}
+
+
+def timed(func):
+    """Records a span for each call of func during a script run, named by the
+    module and qualified name of func, e.g. plots.heatmap."""
+    if not ENABLED:
+        return func
+    name = f"{func.__module__}.{func.__qualname__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        stack = getattr(run_state, "stack", None)
+        if stack is None:
+            # called outside a script run, e.g. by the report generator
+            return func(*args, **kwargs)
+        span = {"name": name, "depth": len(stack), "child_seconds": 0.0}
+        stack.append(span)
+        start_time = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start_time
+            stack.pop()
+            if stack:
+                stack[-1]["child_seconds"] += seconds
+            span["seconds"] = seconds
+            span["self_seconds"] = seconds - span.pop("child_seconds")
+            run_state.spans.append(span)
+
+    return wrapper
+
+
+def start_run():
+    run_state.stack = []
+    run_state.spans = []
+    run_state.start_time = time.perf_counter()
+
+
+def end_run(query_stats: dict = {}):
+    """
+    Closes the spans of the current run: appends them to TIMING_LOG and
+    updates the totals in METRICS_FILE.
+
+    :param query_stats: counters of the query cache at the end of the run
+    :return: seconds of the run, list of its spans in the order they ended
+             and the query cache counters
+    """
+    seconds = time.perf_counter() - run_state.start_time
+    spans = run_state.spans
+    run_state.stack = None
+    with totals_lock:
+        run_totals["runs"] += 1
+        run_totals["seconds"] += seconds
+        cache_stats.update(query_stats)
+        for span in spans:
+            total = totals.setdefault(span["name"], [0, 0.0, 0.0])
+            total[0] += 1
+            total[1] += span["seconds"]
+            total[2] += span["self_seconds"]
+        entry = {
+            "time": datetime.datetime.now().isoformat(timespec="seconds"),
+            "seconds": round(seconds, 6),
+            "spans": [
+                dict(
+                    x,
+                    seconds=round(x["seconds"], 6),
+                    self_seconds=round(x["self_seconds"], 6),
+                )
+                for x in spans
+            ],
+            "query_cache": query_stats,
+        }
+        append_log(entry)
+        write_metrics()
+    return seconds, spans, query_stats
+
+
+def append_log(entry: dict):
+    """Appends entry to TIMING_LOG, which is rotated first if it is full. Only
+    one process rotates it."""
+    max_bytes = TIMING_LOG_MAX_MB * 1024**2
+    if os.path.exists(TIMING_LOG) and os.path.getsize(TIMING_LOG) > max_bytes:
+        with store.file_lock(f"{TIMING_LOG}.lock"):
+            # another process may have rotated it while this one waited
+            if os.path.exists(TIMING_LOG) and os.path.getsize(TIMING_LOG) > max_bytes:
+                os.replace(TIMING_LOG, f"{TIMING_LOG}.1")
+    with open(TIMING_LOG, "a", encoding="utf-8") as file:
+        file.write(json.dumps(entry) + "\n")
+
+
+def get_metrics_file():
+    """Returns the metrics file of the process, e.g. ./data/metrics-1234.prom."""
+    root, extension = os.path.splitext(METRICS_FILE)
+    return f"{root}-{os.getpid()}{extension}"
+
+
+def get_metrics_text():
+    """Returns the totals of the process in the Prometheus text format."""
+    pid = os.getpid()
+    labels = f'{{pid="{pid}"}}'
+    lines = [
+        "# HELP nbcn_run_seconds Seconds per script run.",
+        "# TYPE nbcn_run_seconds summary",
+        f"nbcn_run_seconds_sum{labels} {run_totals['seconds']:.6f}",
+        f"nbcn_run_seconds_count{labels} {run_totals['runs']}",
+        "# HELP nbcn_span_seconds Seconds per call of an instrumented function.",
+        "# TYPE nbcn_span_seconds summary",
+    ]
+    for name, (calls, seconds, _) in sorted(totals.items()):
+        labels = f'{{span="{name}",pid="{pid}"}}'
+        lines.append(f"nbcn_span_seconds_sum{labels} {seconds:.6f}")
+        lines.append(f"nbcn_span_seconds_count{labels} {calls}")
+    lines += [
+        "# HELP nbcn_span_self_seconds_total Seconds in instrumented functions, "
+        "without their instrumented callees.",
+        "# TYPE nbcn_span_self_seconds_total counter",
+    ]
+    for name, (_, _, self_seconds) in sorted(totals.items()):
+        labels = f'{{span="{name}",pid="{pid}"}}'
+        lines.append(f"nbcn_span_self_seconds_total{labels} {self_seconds:.6f}")
+    for key, value in cache_stats.items():
+        kind, description = CACHE_METRICS[key]
+        name = f"nbcn_query_cache_{key}" + ("_total" if kind == "counter" else "")
+        lines += [f"# HELP {name} {description}", f"# TYPE {name} {kind}"]
+        lines.append(f'{name}{{pid="{pid}"}} {value}')
+    return "\n".join(lines) + "\n"
+
+
+def write_metrics():
+    # written to a temporary file first, so a scrape never reads a partial file
+    metrics_file = get_metrics_file()
+    temp_file = f"{metrics_file}.tmp"
+    with open(temp_file, "w", encoding="utf-8") as file:
+        file.write(get_metrics_text())
+    os.replace(temp_file, metrics_file)
+
+
+def get_breakdown(seconds: float, spans: list):
+    """
+    Sums the spans of a run by name. The time not spent in instrumented
+    functions is shown as "other".
+
+    :param seconds: seconds of the run
+    :param spans: spans as returned by end_run
+    :return: DataFrame with span, calls, seconds, self seconds and % of the run
+    """
+    df = pd.DataFrame(spans, columns=["name", "depth", "seconds", "self_seconds"])
+    df = df.groupby("name", sort=False).agg(
+        calls=("seconds", "size"),
+        seconds=("seconds", "sum"),
+        self_seconds=("self_seconds", "sum"),
+    )
+    other_seconds = seconds - df["self_seconds"].sum()
+    df.loc["other"] = [0, other_seconds, other_seconds]
+    df["calls"] = df["calls"].astype(int)
+    df["% of run"] = 100 * df["self_seconds"] / seconds
+    df = df.sort_values(by="self_seconds", ascending=False)
+    return df.reset_index().rename(columns={"name": "span"}).round(4)
+
+
+def show_panel(seconds: float, spans: list, query_stats: dict = {}):
+    """Shows the time breakdown of the run in the sidebar, the labels are not
+    translated since the panel is meant for development."""
+    with st.sidebar.expander("⏱️ Timing", expanded=False):
+        st.markdown(f"Run: {seconds:.3f}s, {len(spans)} spans")
+        if query_stats:
+            st.markdown(
+                "Query cache: {hits} hits, {misses} misses, {evictions} "
+                "evictions, {entries} results, {mb:.1f} MB".format(
+                    mb=query_stats["bytes"] / 1024**2, **query_stats
+                )
+            )
+        st.dataframe(get_breakdown(seconds, spans), hide_index=True)
@@ -2,8 +2,6 @@ import streamlit as st
 import pandas as pd
 import numpy as np
 import os
-import pymannkendall as mk
-from scipy import stats
 
 from plots import time_series_chart
 from helper import init_lang_dict_complete, get_lang, show_filter
@@ -11,6 +9,115 @@ from helper import init_lang_dict_complete, get_lang, show_filter
 PAGE = __name__
 lang = {}
 MIN_POINTS = 8
+TREND_KEYS = ["increasing", "decreasing", "no trend"]
+
+
+def get_season_array(df: pd.DataFrame, value: str, keys: dict):
+    """
+    Pivots the values of each group into an array of shape
+    groups x years x seasons, missing values are set to NaN.
+
+    :param df: DataFrame with the group, year, season and value columns
+    :param value: column holding the values
+    :param keys: column names for "group", "year" and "season"
+    :return: group labels, season array
+    """
+    df = df.dropna(subset=[value])
+    groups, group_idx = np.unique(df[keys["group"]].astype(str), return_inverse=True)
+    years = df[keys["year"]].to_numpy(dtype=int)
+    seasons, season_idx = np.unique(df[keys["season"]], return_inverse=True)
+    values = np.full((len(groups), years.max() - years.min() + 1, len(seasons)), np.nan)
+    values[group_idx, years - years.min(), season_idx] = df[value].to_numpy(float)
+    return groups, values
+
+
+def seasonal_mann_kendall(
+    df: pd.DataFrame,
+    parameters: list,
+    keys: dict = {"group": "station", "year": "year", "season": "month"},
+    min_points: int = 0,
+    alpha: float = 0.05,
+):
+    """
+    Seasonal Mann-Kendall test (Hirsch & Slack 1984) and seasonal Sen's slope
+    for all groups and parameters at once. The S-statistic and the pairwise
+    slopes are computed on an array of shape groups x years x seasons, one
+    year lag at a time, instead of calling pymannkendall.seasonal_test for
+    each station. Seasons are aligned by the season column, so gaps in the
+    series do not shift the months, results are equal to seasonal_test for
+    gap free series.
+
+    :param df: aggregated data with the group, year, season and parameter columns
+    :param parameters: parameter columns to be tested
+    :param keys: column names for "group", "year" and "season"
+    :param min_points: groups with min_points values or less are not tested
+    :param alpha: significance level
+    :return: DataFrame with one row per group and parameter and the columns
+             trend, h, p, z, tau, s, var_s, slope and points
+    """
+    # scipy takes longer to import than most pages take to render
+    from scipy.stats import norm
+
+    columns = [keys["group"], "parameter", "trend", "h", "p", "z", "tau", "s"]
+    columns += ["var_s", "slope", "points"]
+    result = []
+    for par in parameters:
+        if df[par].count() == 0:
+            continue
+        groups, values = get_season_array(df, par, keys)
+        years = values.shape[1]
+        s = np.zeros(len(groups))
+        slopes = []
+        for lag in range(1, years):
+            diff = values[:, lag:, :] - values[:, :-lag, :]
+            s += np.nansum(np.sign(diff), axis=(1, 2))
+            slopes.append(diff.reshape(len(groups), -1) / lag)
+        if slopes == []:
+            slope = np.full(len(groups), np.nan)
+        else:
+            slope = np.nanmedian(np.concatenate(slopes, axis=1), axis=1)
+
+        # variance of S with ties, summed over seasons
+        n = np.sum(~np.isnan(values), axis=1)
+        ties = (
+            df.dropna(subset=[par])
+            .groupby([keys["group"], keys["season"], par], observed=True)
+            .size()
+        )
+        ties = ties * (ties - 1) * (2 * ties + 5)
+        ties = ties.groupby(level=0, observed=True).sum()
+        ties = ties.reindex(groups, fill_value=0).to_numpy()
+        var_s = (np.sum(n * (n - 1) * (2 * n + 5), axis=1) - ties) / 18
+        denom = np.sum(0.5 * n * (n - 1), axis=1)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            z = np.where(s > 0, s - 1, np.where(s < 0, s + 1, 0)) / np.sqrt(var_s)
+            tau = s / denom
+        z = np.where(s == 0, 0, z)
+        p = 2 * (1 - norm.cdf(np.abs(z)))
+        h = np.abs(z) > norm.ppf(1 - alpha / 2)
+        trend = np.select([h & (z > 0), h & (z < 0)], TREND_KEYS[:2], TREND_KEYS[2])
+        result.append(
+            pd.DataFrame(
+                {
+                    columns[0]: groups,
+                    "parameter": par,
+                    "trend": trend,
+                    "h": h,
+                    "p": p,
+                    "z": z,
+                    "tau": tau,
+                    "s": s,
+                    "var_s": var_s,
+                    "slope": slope,
+                    "points": n.sum(axis=1),
+                }
+            )
+        )
+    if result == []:
+        return pd.DataFrame(columns=columns)
+    result = pd.concat(result, ignore_index=True)
+    return result[result["points"] > min_points].reset_index(drop=True)
 
 
 class TrendAnalysis:
@@ -28,6 +135,8 @@ class TrendAnalysis:
         self.parameter = ""
 
     def get_lin_reg(self, df: pd.DataFrame):
+        from scipy import stats
+
         df = df.dropna(how="all")
         if len(df) > 2:
             df["X_numeric"] = (df["date"] - df["date"].min()).dt.days
@@ -103,19 +212,6 @@ class TrendAnalysis:
             df = pd.DataFrame({"Parameter": keys, "Value": values})
             return df
 
-        def show_result(result):
-            ok = display == lang["display-options"][0]
-            ok = ok or (
-                display == lang["display-options"][1] and result.trend == "increasing"
-            )
-            ok = ok or (
-                display == lang["display-options"][2] and result.trend == "decreasing"
-            )
-            ok = ok or (
-                display == lang["display-options"][3] and result.trend == "no trend"
-            )
-            return ok
-
         self.parameter = st.sidebar.selectbox(
             label=lang["parameter"],
             options=list(self.parameters_dict.keys()),
@@ -144,34 +240,42 @@ class TrendAnalysis:
         max_y = int(station_data[self.parameter].max()) + 1
         settings["y_domain"] = [min_y, max_y]
         cnt_stations = 0
-        cnt_all_stations = 0
+
+        results = seasonal_mann_kendall(
+            station_data,
+            [self.parameter],
+            keys={"group": "Station", "year": "Year", "season": "Month"},
+            min_points=MIN_POINTS,
+        )
+        display_index = display_options.index(display)
+        if display_index > 0:
+            results = results[results["trend"] == TREND_KEYS[display_index - 1]]
+        results = results.set_index("Station")
 
         for station in self.stations_dict.keys():
+            if station not in results.index:
+                continue
+            result = results.loc[station]
             cols = st.columns([3, 1])
             df = station_data[station_data["Station"] == station].sort_values(by="Date")
             df = df.dropna(subset=[self.parameter])
-            if len(df) > MIN_POINTS:
-                # settings['x_domain'] = [ f"{df['month_date'].min().year}-01-01", f"{df['month_date'].max().year}-12-31"]
-                cnt_all_stations += 1
-                values = list(df[self.parameter])
-                result = mk.seasonal_test(values, 12)
-                settings[
-                    "title"
-                ] = f"{self.stations_dict[station]} ({station}): {result.trend}"
-                with cols[0]:
-                    if settings["show_regression"]:
-                        slope, intercept, r_value, p_value, std_err = self.get_lin_reg(
-                            station_data
-                        )
-
-                    time_series_chart(df, settings)
-                with cols[1]:
-                    summary_df = get_summary_df(df, result)
-                    st.dataframe(summary_df, hide_index=True)
-                cnt_stations += 1
-                num_stations.markdown(
-                    f"{cnt_stations} of {len(self.stations_dict)} stations shown"
-                )
+            settings["title"] = (
+                f"{self.stations_dict[station]} ({station}): {result.trend}"
+            )
+            with cols[0]:
+                if settings["show_regression"]:
+                    slope, intercept, r_value, p_value, std_err = self.get_lin_reg(
+                        station_data
+                    )
+
+                time_series_chart(df, settings)
+            with cols[1]:
+                summary_df = get_summary_df(df, result)
+                st.dataframe(summary_df, hide_index=True)
+            cnt_stations += 1
+            num_stations.markdown(
+                f"{cnt_stations} of {len(self.stations_dict)} stations shown"
+            )
 
     def run(self):
         analysis_options = lang["analysis-options"]